@@ -1,24 +1,36 @@
+import json
+import re
 import requests
 from requests.exceptions import RequestException
 from ratelimit import limits, sleep_and_retry
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from typing import List, Dict, Any
+from threading import Lock
+from typing import List, Dict, Any, Callable, Iterator, Mapping, Optional, Tuple
 
 from authentication import get_token
+from config import CONFIG
+from profiling import timed
+from retries import MalformedResponseError, call_with_retries
 from utils import get_logger
 
 logger = get_logger()
 
-# Configure retry strategy
+# Configure retry strategy: only failed connects are retried here, since nothing
+# was sent yet; error responses and timeouts are retried per request by
+# retries.call_with_retries, with jittered backoff and the run's retry budget
 retry_strategy = Retry(
-    total=5,
-    backoff_factor=1,
-    status_forcelist=[500, 502, 503, 504],
+    total=2,
+    connect=2,
+    read=0,
+    status=0,
+    backoff_factor=0.5,
     allowed_methods=["GET"],
     raise_on_status=False
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+# enough pooled connections for several endpoints of several tenants at once,
+# so concurrent syncs reuse connections instead of discarding them
+adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=32)
 session = requests.Session()
 session.mount("https://", adapter)
 session.mount("http://", adapter)
@@ -27,64 +39,177 @@ session.mount("http://", adapter)
 RATE_LIMIT_CALLS = 60
 RATE_LIMIT_PERIOD = 50  # seconds
 
-@sleep_and_retry
-@limits(calls=RATE_LIMIT_CALLS, period=RATE_LIMIT_PERIOD)
-def fetch_data_from_endpoint(endpoint: str, client_id: str, page_size: int = 100) -> List[Dict[str, Any]]:
+# remaining-call counters reported by Xero on every response, per client
+RATE_LIMIT_HEADERS = {
+    'X-DayLimit-Remaining': 'day_remaining',
+    'X-MinLimit-Remaining': 'minute_remaining',
+    'X-AppMinLimit-Remaining': 'app_minute_remaining',
+}
+rate_limits: Dict[str, Dict[str, int]] = {}
+
+# Xero limits calls per tenant, so each client gets its own limiter and a busy
+# tenant never slows down another one synced by the same process. the limit is
+# shared by every task of a sharded run, so each task gets its share of it
+_client_limiters: Dict[str, Callable[..., bytes]] = {}
+_client_limiters_lock = Lock()
+
+def record_rate_limits(client_id: str, headers: Mapping[str, str]) -> None:
     """
-    fetches all data from a specified Xero API endpoint using pagination
+    keeps the latest rate-limit counters Xero reported for a client
     """
-    all_data = []
-    page = 1
+    observed = {
+        key: int(headers[header])
+        for header, key in RATE_LIMIT_HEADERS.items()
+        if headers.get(header, '').isdigit()
+    }
+    if observed:
+        rate_limits[client_id] = {**rate_limits.get(client_id, {}), **observed}
+
+# pagination metadata precedes the items in Xero responses, so the page count
+# can usually be read without decoding the whole page
+_PAGE_COUNT_PATTERN = re.compile(rb'"pageCount"\s*:\s*(\d+)')
+_PAGE_COUNT_SCAN_BYTES = 1024
+
+def items_key_for(endpoint: str) -> str:
+    """
+    returns the response key holding the records of an endpoint, e.g. 'BankTransactions'
+    """
+    return endpoint.rstrip('/').split('/')[-1]
 
-    while True:
+def read_page_count(content: bytes) -> Optional[int]:
+    """
+    returns the total page count advertised by a response, or None if the
+    endpoint is not paginated
+    """
+    match = _PAGE_COUNT_PATTERN.search(content, 0, _PAGE_COUNT_SCAN_BYTES)
+    if match:
+        return int(match.group(1))
+    return json.loads(content).get('pagination', {}).get('pageCount')
+
+def parse_page(content: bytes, endpoint: str) -> List[Dict[str, Any]]:
+    """
+    decodes a raw response page and returns its records
+    """
+    return json.loads(content).get(items_key_for(endpoint), [])
+
+def fetch_content(endpoint: str, client_id: str, params: Dict[str, Any], description: str) -> bytes:
+    """
+    sends a rate-limited GET request to a Xero API endpoint, retrying transient
+    failures, and returns the raw response body
+
+    Args:
+        endpoint (str): the endpoint URL
+        client_id (str): the tenant to fetch for
+        params (Dict[str, Any]): query parameters
+        description (str): what is being fetched, for logging, e.g. 'page 3'
+    """
+    with _client_limiters_lock:
+        if client_id not in _client_limiters:
+            task_calls = max(RATE_LIMIT_CALLS // CONFIG['SHARD_TASK_COUNT'], 1)
+            _client_limiters[client_id] = sleep_and_retry(
+                limits(calls=task_calls, period=RATE_LIMIT_PERIOD)(send_request)
+            )
+        limited_send_request = _client_limiters[client_id]
+    # every attempt passes the rate limiter again
+    return call_with_retries(
+        client_id, description,
+        lambda: limited_send_request(endpoint, client_id, params, description),
+    )
+
+def send_request(endpoint: str, client_id: str, params: Dict[str, Any], description: str) -> bytes:
+    """
+    sends a single GET request to a Xero API endpoint without rate limiting or retries; use fetch_content
+    """
+    with timed('auth'):
         token = get_token(client_id)
-        headers = {
-            'Authorization': f'Bearer {token["access_token"]}',
-            'xero-tenant-id': client_id,
-            'Accept': 'application/json'
-        }
-        params = {
-            'page': page,
-            'pageSize': page_size
-        }
-
-        try:
-            logger.info(f"fetching page {page} from {endpoint} for client {client_id}")
-            # response = session.get(endpoint, headers=headers, params=params, timeout=30)
-            response = session.get(endpoint, headers=headers)
-            # print(headers)
-            if response.status_code == 429:
-                logger.warning(f"rate limit exceeded when accessing {endpoint} for client {client_id}. retrying...")
-                raise RequestException("rate limit exceeded")
-
-            response.raise_for_status()
-            data = response.json()
-
-            # extract pagination info and data items
-            pagination = data.get('pagination', {})
-            items_key = endpoint.rstrip('/').split('/')[-1]  # e.g., 'BankTransactions'
-            actual_data = data.get(items_key, [])
-
-            logger.debug(f"page {page} fetched with {len(actual_data)} items.")
-
-            if not actual_data:
-                logger.info(f"no more data found on page {page}. Ending pagination.")
-                break
-
-            all_data.extend(actual_data)
-
-            # check if we've reached the last page
-            if page >= pagination.get('pageCount', page):
-                logger.info(f"all pages fetched for {endpoint} for client {client_id}.")
-                break
-
-            page += 1
-
-        except RequestException as e:
-            logger.error(f"failed to fetch data from {endpoint} for client {client_id} on page {page}: {str(e)}")
-            raise
-        except Exception as e:
-            logger.error(f"an unexpected error occurred while fetching data from {endpoint} for client {client_id}: {str(e)}")
-            raise
+    headers = {
+        'Authorization': f'Bearer {token["access_token"]}',
+        'xero-tenant-id': client_id,
+        'Accept': 'application/json'
+    }
+
+    try:
+        logger.info(f"fetching {description} from {endpoint} for client {client_id}")
+        with timed('fetch'):
+            response = session.get(endpoint, headers=headers, params=params, timeout=30)
+        record_rate_limits(client_id, response.headers)
+        if response.status_code == 429:
+            logger.warning(f"rate limit exceeded when accessing {endpoint} for client {client_id}")
+
+        response.raise_for_status()
+        # Xero responds with JSON objects; anything else was cut off on the way
+        if not response.content.rstrip().endswith(b"}"):
+            raise MalformedResponseError(f"truncated response body ({len(response.content)} bytes)")
+        return response.content
+
+    except RequestException as e:
+        logger.error(f"failed to fetch data from {endpoint} for client {client_id} ({description}): {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"an unexpected error occurred while fetching data from {endpoint} for client {client_id}: {str(e)}")
+        raise
+
+def fetch_page(
+    endpoint: str,
+    client_id: str,
+    page: int,
+    page_size: int = 100,
+    where: Optional[str] = None,
+) -> bytes:
+    """
+    fetches a single page from a specified Xero API endpoint, optionally
+    filtered by a `where` clause, and returns the raw response body
+    """
+    params = {
+        'page': page,
+        'pageSize': page_size
+    }
+    if where:
+        params['where'] = where
+    return fetch_content(endpoint, client_id, params, f"page {page}")
+
+def fetch_report(endpoint: str, client_id: str, params: Dict[str, str]) -> bytes:
+    """
+    fetches a Xero report with the given parameters (e.g. its date) and returns the raw response body
+    """
+    description = "report " + ", ".join(f"{key}={value}" for key, value in params.items())
+    return fetch_content(endpoint, client_id, params, description)
+
+def iter_pages(
+    endpoint: str,
+    client_id: str,
+    page_size: int = 100,
+    start_page: int = 1,
+    end_page: Optional[int] = None,
+    where: Optional[str] = None,
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    yields (page number, raw response body) for every page of an endpoint, or
+    for the pages from start_page up to and including end_page
+    """
+    page = start_page
+    while True:
+        content = fetch_page(endpoint, client_id, page, page_size, where)
+        yield page, content
 
+        # non-paginated endpoints return everything on the first page
+        page_count = read_page_count(content)
+        if page_count is None or page >= page_count:
+            logger.info(f"all pages fetched for {endpoint} for client {client_id}.")
+            break
+        if end_page is not None and page >= end_page:
+            logger.info(f"pages {start_page}-{end_page} fetched for {endpoint} for client {client_id}.")
+            break
+
+        page += 1
+
+def fetch_data_from_endpoint(endpoint: str, client_id: str, page_size: int = 100) -> List[Dict[str, Any]]:
+    """
+    fetches all data from a specified Xero API endpoint using pagination
+    """
+    all_data = []
+    for page, content in iter_pages(endpoint, client_id, page_size):
+        actual_data = parse_page(content, endpoint)
+        logger.debug(f"page {page} fetched with {len(actual_data)} items.")
+        all_data.extend(actual_data)
     return all_data
\ No newline at end of file
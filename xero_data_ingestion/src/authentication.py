@@ -1,17 +1,26 @@
 import json
+import os
+import tempfile
 import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet
 from google.cloud import secretmanager
 from requests_oauthlib import OAuth2Session
 from threading import Lock
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, List, Optional
 
 from config import CONFIG
 from utils import get_logger
 
 logger = get_logger()
 
-# initialize Secret Manager client once
-client = secretmanager.SecretManagerServiceClient()
+# secrets holding the Xero app's OAuth credentials
+APP_ID_SECRET = "core-client-id-xero"
+APP_SECRET_SECRET = "core-client-secret-xero"
+
+# expired tokens read longer ago than this are read again before refreshing them
+TOKEN_REREAD_SECONDS = 60
 
 # simple cache to store tokens without fixed TTL
 _token_cache = {}
@@ -23,35 +32,221 @@ class SecretManagerError(Exception):
 class TokenRetrievalError(Exception):
     pass
 
-def get_secret(secret_id: str) -> str:
+def token_secret_id(client_id: str) -> str:
+    return f"client-{client_id}-token-xero"
+
+class TokenStore(ABC):
     """
-    retrieves a secret from Google Secret Manager
+    reads and writes the secrets the pipeline authenticates with: the app's
+    credentials and each tenant's tokens
+
+    values are cached once read, so a secret costs one round trip per process
+    however often it is needed; preload() fetches several of them at once
     """
-    try:
-        name = f"{CONFIG['PROJECT_NUMBER']}/secrets/{secret_id}/versions/latest"
-        response = client.access_secret_version(name=name)
-        secret_value = response.payload.data.decode('UTF-8')
-        logger.debug(f"successfully retrieved secret {secret_id}")
-        return secret_value
-    except Exception as e:
-        logger.error(f"error accessing secret {secret_id}: {str(e)}")
-        raise SecretManagerError(f"failed to access secret {secret_id}") from e
+
+    def __init__(self):
+        # secret ID -> (value, time it was read)
+        self._values: Dict[str, Tuple[str, float]] = {}
+        self._lock = Lock()
+
+    @abstractmethod
+    def fetch(self, secret_id: str) -> str:
+        """
+        reads the latest value of a secret from the backend, bypassing the cache
+        """
+
+    @abstractmethod
+    def save(self, secret_id: str, value: str) -> None:
+        """
+        writes a new value of a secret to the backend
+        """
+
+    def read(self, secret_id: str, max_age: Optional[float] = None) -> str:
+        """
+        returns a secret, from the cache unless it was read more than `max_age` seconds ago
+        """
+        with self._lock:
+            cached = self._values.get(secret_id)
+        if cached and (max_age is None or time.time() - cached[1] <= max_age):
+            return cached[0]
+        value = self.fetch(secret_id)
+        with self._lock:
+            self._values[secret_id] = (value, time.time())
+        return value
+
+    def write(self, secret_id: str, value: str) -> None:
+        self.save(secret_id, value)
+        with self._lock:
+            self._values[secret_id] = (value, time.time())
+
+    def preload(self, secret_ids: List[str]) -> None:
+        """
+        reads secrets concurrently and caches them; a secret that cannot be read
+        is left for read() to fail on when it is actually needed
+        """
+        missing = [secret_id for secret_id in secret_ids if secret_id not in self._values]
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {secret_id: executor.submit(self.read, secret_id) for secret_id in missing}
+        for secret_id, future in futures.items():
+            if future.exception():
+                logger.warning(f"could not preload secret {secret_id}: {str(future.exception())}")
+
+class SecretManagerTokenStore(TokenStore):
+    """
+    keeps secrets in Google Secret Manager, one secret per value
+
+    every write adds a version, so older versions beyond TOKEN_VERSIONS_TO_KEEP
+    are destroyed after each write rather than piling up
+    """
+
+    def __init__(self, project_number: str, versions_to_keep: int):
+        super().__init__()
+        self.project_number = project_number
+        self.versions_to_keep = versions_to_keep
+        # one client, so concurrent reads share its channel and credentials. it is
+        # created on first use, so importing this module opens no gRPC channel
+        # before the transform workers are forked
+        self._client = None
+        self._client_lock = Lock()
+
+    @property
+    def client(self) -> secretmanager.SecretManagerServiceClient:
+        with self._client_lock:
+            if self._client is None:
+                self._client = secretmanager.SecretManagerServiceClient()
+            return self._client
+
+    def fetch(self, secret_id: str) -> str:
+        try:
+            name = f"{self.project_number}/secrets/{secret_id}/versions/latest"
+            response = self.client.access_secret_version(name=name)
+            secret_value = response.payload.data.decode('UTF-8')
+            logger.debug(f"successfully retrieved secret {secret_id}")
+            return secret_value
+        except Exception as e:
+            logger.error(f"error accessing secret {secret_id}: {str(e)}")
+            raise SecretManagerError(f"failed to access secret {secret_id}") from e
+
+    def save(self, secret_id: str, value: str) -> None:
+        parent = f"{self.project_number}/secrets/{secret_id}"
+        try:
+            self.client.add_secret_version(
+                parent=parent,
+                payload={"data": value.encode("UTF-8")}
+            )
+        except Exception as e:
+            logger.error(f"error storing secret {secret_id}: {str(e)}")
+            raise SecretManagerError(f"failed to store secret {secret_id}") from e
+        self.prune_versions(parent)
+
+    def prune_versions(self, parent: str) -> None:
+        """
+        destroys the enabled versions of a secret beyond the newest
+        `versions_to_keep`; failures are logged, the new version is already stored
+        """
+        try:
+            versions = sorted(
+                self.client.list_secret_versions(request={"parent": parent, "filter": "state:ENABLED"}),
+                key=lambda version: version.create_time,
+                reverse=True,
+            )
+            for version in versions[self.versions_to_keep:]:
+                self.client.destroy_secret_version(name=version.name)
+                logger.debug(f"destroyed secret version {version.name}")
+        except Exception as e:
+            logger.warning(f"error pruning old versions of {parent}: {str(e)}")
+
+class LocalTokenStore(TokenStore):
+    """
+    keeps secrets in a local file encrypted with a Fernet key, for development
+    and benchmarking without Secret Manager round trips
+
+    the file holds one JSON object of secret ID -> value; create a key with
+    `Fernet.generate_key()`
+    """
+
+    def __init__(self, path: str, key: str):
+        super().__init__()
+        self.path = path
+        self.fernet = Fernet(key.encode("UTF-8"))
+        self._file_lock = Lock()
+
+    def load_file(self) -> Dict[str, str]:
+        try:
+            with open(self.path, "rb") as store:
+                return json.loads(self.fernet.decrypt(store.read()))
+        except FileNotFoundError:
+            return {}
+
+    def fetch(self, secret_id: str) -> str:
+        values = self.load_file()
+        if secret_id not in values:
+            raise SecretManagerError(f"secret {secret_id} not found in {self.path}")
+        return values[secret_id]
+
+    def preload(self, secret_ids: List[str]) -> None:
+        # the whole file is a single read
+        values = self.load_file()
+        with self._lock:
+            self._values.update({
+                secret_id: (values[secret_id], time.time())
+                for secret_id in secret_ids
+                if secret_id in values
+            })
+
+    def save(self, secret_id: str, value: str) -> None:
+        with self._file_lock:
+            values = {**self.load_file(), secret_id: value}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            # write aside, then replace, so a crash never leaves a truncated store
+            with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".staged-", delete=False) as staged:
+                staged.write(self.fernet.encrypt(json.dumps(values).encode("UTF-8")))
+            os.replace(staged.name, self.path)
+
+def get_token_store() -> TokenStore:
+    """
+    returns the configured token store: the local encrypted file if
+    TOKEN_STORE=local, otherwise Secret Manager
+    """
+    if CONFIG['TOKEN_STORE'] == 'local':
+        if not CONFIG['TOKEN_STORE_KEY']:
+            raise ValueError("the local token store needs TOKEN_STORE_KEY to decrypt it")
+        return LocalTokenStore(CONFIG['TOKEN_STORE_PATH'], CONFIG['TOKEN_STORE_KEY'])
+    return SecretManagerTokenStore(CONFIG['PROJECT_NUMBER'], CONFIG['TOKEN_VERSIONS_TO_KEEP'])
+
+# initialize the token store once
+token_store = get_token_store()
+
+def get_secret(secret_id: str, max_age: Optional[float] = None) -> str:
+    """
+    retrieves a secret from the token store
+    """
+    return token_store.read(secret_id, max_age)
+
+def preload_secrets(client_ids: List[str]) -> None:
+    """
+    reads the app credentials and the tokens of the given tenants in one
+    concurrent batch, so the run does not wait on them one at a time
+    """
+    token_store.preload([APP_ID_SECRET, APP_SECRET_SECRET, *(token_secret_id(client_id) for client_id in client_ids)])
 
 def get_app_credentials() -> Tuple[str, str]:
     """
-    retrieves the application's APP_ID and APP_SECRET from Secret Manager
+    retrieves the application's APP_ID and APP_SECRET from the token store
     """
-    APP_ID = get_secret("core-client-id-xero")
-    APP_SECRET = get_secret("core-client-secret-xero")
+    APP_ID = get_secret(APP_ID_SECRET)
+    APP_SECRET = get_secret(APP_SECRET_SECRET)
     return APP_ID, APP_SECRET
 
-def retrieve_tokens(client_id: str) -> Dict[str, Any]:
+def retrieve_tokens(client_id: str, max_age: Optional[float] = None) -> Dict[str, Any]:
     """
-    retrieves stored tokens for a client from Secret Manager
+    retrieves stored tokens for a client from the token store
     """
     try:
-        secret_id = f"client-{client_id}-token-xero"
-        tokens_json = get_secret(secret_id)
+        secret_id = token_secret_id(client_id)
+        tokens_json = get_secret(secret_id, max_age)
         
         logger.debug(f"successfully retrieved tokens for client {client_id}")
         
@@ -82,17 +277,10 @@ def retrieve_tokens(client_id: str) -> Dict[str, Any]:
 
 def store_tokens(client_id: str, tokens: Dict[str, Any]) -> None:
     """
-    stores tokens for a client in Secret Manager
+    stores tokens for a client in the token store
     """
     try:
-        secret_id = f"client-{client_id}-token-xero"
-        parent = f"{CONFIG['PROJECT_NUMBER']}/secrets/{secret_id}"
-
-        payload = json.dumps(tokens).encode("UTF-8")
-        client.add_secret_version(
-            parent=parent,
-            payload={"data": payload}
-        )
+        token_store.write(token_secret_id(client_id), json.dumps(tokens))
         logger.info(f"Stored tokens for client {client_id}")
     except Exception as e:
         logger.error(f"error storing tokens for client {client_id}: {str(e)}")
@@ -131,14 +319,14 @@ def get_token(client_id: str) -> Dict[str, Any]:
             return cached
 
         tokens = retrieve_tokens(client_id)
-        
-        # set 'expires_at' if not present
-        if 'expires_at' not in tokens:
-            tokens['expires_at'] = time.time() + tokens.get('expires_in', 1800)
-            store_tokens(client_id, tokens)  # persist the updated tokens
+        if tokens.get('expires_at', 0) < time.time():
+            # another process may have refreshed (and so rotated) the tokens since they were read
+            tokens = retrieve_tokens(client_id, max_age=TOKEN_REREAD_SECONDS)
 
-        # refresh if expired
-        print(tokens.get('expires_at', 0), time.time())
+        # refresh if expired; tokens stored without 'expires_at' have an unknown
+        # issue time, so they are refreshed too rather than given a guessed expiry.
+        # only a refresh writes back to the token store
+        logger.debug(f"token for client {client_id} expires at {tokens.get('expires_at', 0)}, now {time.time()}")
         if tokens.get('expires_at', 0) < time.time():
             tokens = refresh_access_token(client_id, tokens.get('refresh_token'))
         
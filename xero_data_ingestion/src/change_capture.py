@@ -0,0 +1,113 @@
+import hashlib
+import json
+from typing import Any, Dict, FrozenSet, List, Optional
+
+# field added to every emitted record describing the change it represents
+CDC_OPERATION_FIELD = "cdc_operation"
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+# hash indexes live next to the endpoint exports in the client bucket
+INDEX_PREFIX = "_cdc"
+
+def index_file_name(name: str) -> str:
+    """
+    returns the bucket path of the hash index for an endpoint
+
+    Args:
+        name (str): the endpoint name, e.g. 'invoices'
+    """
+    return f"{INDEX_PREFIX}/{name}.index.json"
+
+def pending_index_file_name(name: str) -> str:
+    """
+    returns the bucket path of the hash index a run collected for an endpoint
+    whose delta is not loaded yet
+    """
+    return f"{INDEX_PREFIX}/{name}.pending.json"
+
+def record_hash(record: Dict[str, Any], volatile_fields: FrozenSet[str]) -> str:
+    """
+    returns a short, stable digest of a record, ignoring volatile fields
+
+    keys are sorted before hashing so the digest does not depend on the
+    order in which the API happened to serialize the record
+
+    Args:
+        record (Dict[str, Any]): the record as returned by the API
+        volatile_fields (FrozenSet[str]): top-level fields to leave out of the digest
+    """
+    stable = {key: value for key, value in record.items() if key not in volatile_fields}
+    payload = json.dumps(stable, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(payload.encode("UTF-8"), digest_size=8).hexdigest()
+
+def parse_index(content: Optional[str]) -> Dict[str, str]:
+    """
+    parses a persisted hash index, treating a missing index as empty
+    """
+    if not content:
+        return {}
+    return json.loads(content).get("hashes", {})
+
+def serialize_index(id_field: str, hashes: Dict[str, str]) -> str:
+    """
+    serializes a hash index as a compact JSON document sorted by record ID
+    """
+    return json.dumps(
+        {"id_field": id_field, "hashes": dict(sorted(hashes.items()))},
+        separators=(",", ":"),
+    )
+
+class ChangeTracker:
+    """
+    classifies records as inserts, updates or unchanged against the hash index
+    of the previous run, and collects the index for the current run
+    """
+
+    def __init__(self, id_field: str, previous_index: Dict[str, str]):
+        self.id_field = id_field
+        self.previous_index = previous_index
+        self.index: Dict[str, str] = {}
+        self.counts = {INSERT: 0, UPDATE: 0, DELETE: 0, "unchanged": 0}
+
+    def classify(self, record_id: Optional[str], digest: str) -> Optional[str]:
+        """
+        records the digest of a record and returns the change it represents
+
+        Returns:
+            Optional[str]: 'insert', 'update', or None if the record is unchanged
+        """
+        if record_id is None:
+            # without a key we cannot track the record, so always emit it
+            self.counts[INSERT] += 1
+            return INSERT
+
+        record_id = str(record_id)
+        self.index[record_id] = digest
+        previous = self.previous_index.get(record_id)
+        if previous is None:
+            operation = INSERT
+        elif previous != digest:
+            operation = UPDATE
+        else:
+            self.counts["unchanged"] += 1
+            return None
+        self.counts[operation] += 1
+        return operation
+
+    def carry_over_unseen(self) -> None:
+        """
+        keeps the previous digests of records this run did not reach, for a run
+        that ended early: their changes are then still detected by the next run
+        """
+        self.index = {**self.previous_index, **self.index}
+
+    def tombstones(self) -> List[Dict[str, Any]]:
+        """
+        returns a delete record for every ID in the previous index that was not
+        seen in this run
+        """
+        deleted = sorted(self.previous_index.keys() - self.index.keys())
+        self.counts[DELETE] = len(deleted)
+        return [{self.id_field: record_id, CDC_OPERATION_FIELD: DELETE} for record_id in deleted]
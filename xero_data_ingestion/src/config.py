@@ -1,13 +1,21 @@
 import os
-from typing import Dict, Any
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Iterator, Optional
 from google.cloud import resourcemanager_v3
 
-def get_env_variable(var_name: str) -> str:
-    value = os.environ.get(var_name)
+def get_env_variable(var_name: str, default: Optional[str] = None) -> str:
+    value = os.environ.get(var_name, default)
     if value is None:
         raise ValueError(f"Environment variable {var_name} is not set")
     return value
 
+def get_env_flag(var_name: str, default: bool = False) -> bool:
+    """
+    reads a boolean feature flag from the environment ('1', 'true', 'yes' are truthy)
+    """
+    return get_env_variable(var_name, str(default)).strip().lower() in ("1", "true", "yes")
+
 def get_project_number(project_id: str) -> str:
     """
     retrieves the project number for a given project ID
@@ -28,17 +36,26 @@ def get_project_number(project_id: str) -> str:
     except Exception as e:
         raise RuntimeError(f"failed to get project number for {project_id}: {e}")
 
+def get_tenant_config(client_id: str, project_number: str) -> Dict[str, Any]:
+    """
+    returns the settings that depend on the tenant (the Xero organisation) being synced
+    """
+    return {
+        "CLIENT_ID": client_id,
+        "BUCKET_NAME": f"client-{client_id}-bucket-xero",
+        "SECRETS_PATH": f"{project_number}/secrets/client-{client_id}-token-xero",
+    }
+
 def get_client_config() -> Dict[str, Any]:
     client_id = get_env_variable("CLIENT_ID")
     project_id = get_env_variable("PROJECT_ID")
-    project_number = get_project_number(project_id)
+    # resolving the project number costs a Resource Manager call; it can be given instead
+    project_number = os.environ.get("PROJECT_NUMBER") or get_project_number(project_id)
 
     return {
-        "CLIENT_ID": client_id,
+        **get_tenant_config(client_id, project_number),
         "PROJECT_ID": project_id,
         "PROJECT_NUMBER": project_number,
-        "BUCKET_NAME": f"client-{client_id}-bucket-xero",
-        "SECRETS_PATH": f"{project_number}/secrets/client-{client_id}-token-xero",
     }
 
 ENDPOINT_BASE = 'https://api.xero.com/api.xro/2.0/'
@@ -78,7 +95,198 @@ ENDPOINTS = {
     # 'users': ENDPOINT_BASE + 'Users',
 }
 
-CONFIG = {
+# primary key of the records returned by each endpoint, used for change detection
+ENDPOINT_ID_FIELDS = {
+    'accounts': 'AccountID',
+    'bank_transactions': 'BankTransactionID',
+    'bank_transfers': 'BankTransferID',
+    'batch_payments': 'BatchPaymentID',
+    'branding_themes': 'BrandingThemeID',
+    'budgets': 'BudgetID',
+    'contact_groups': 'ContactGroupID',
+    'contacts': 'ContactID',
+    'credit_notes': 'CreditNoteID',
+    'currencies': 'Code',
+    'employees': 'EmployeeID',
+    'invoices': 'InvoiceID',
+    'items': 'ItemID',
+    'journals': 'JournalID',
+    'linked_transactions': 'LinkedTransactionID',
+    'manual_journals': 'ManualJournalID',
+    'organisation': 'OrganisationID',
+    'overpayments': 'OverpaymentID',
+    'payment_services': 'PaymentServiceID',
+    'payments': 'PaymentID',
+    'prepayments': 'PrepaymentID',
+    'purchase_orders': 'PurchaseOrderID',
+    'quotes': 'QuoteID',
+    'repeating_invoices': 'RepeatingInvoiceID',
+    'tax_rates': 'TaxType',
+    'tracking_categories': 'TrackingCategoryID',
+    'users': 'UserID',
+}
+
+# fields that change without the record itself changing; excluded from record hashes
+CDC_VOLATILE_FIELDS = frozenset({
+    'ingestion_time',
+    'StatusAttributeString',
+    'ValidationErrors',
+    'Warnings',
+})
+
+# nested arrays exploded into child tables named '<endpoint>__<child>', keyed by the parent's ID
+NESTED_ARRAYS = {
+    'bank_transactions': {'line_items': 'LineItems'},
+    'batch_payments': {'payments': 'Payments'},
+    'credit_notes': {'line_items': 'LineItems', 'allocations': 'Allocations', 'payments': 'Payments'},
+    'invoices': {'line_items': 'LineItems', 'payments': 'Payments'},
+    'journals': {'journal_lines': 'JournalLines'},
+    'manual_journals': {'journal_lines': 'JournalLines'},
+    'overpayments': {'line_items': 'LineItems', 'allocations': 'Allocations', 'payments': 'Payments'},
+    'prepayments': {'line_items': 'LineItems', 'allocations': 'Allocations', 'payments': 'Payments'},
+    'purchase_orders': {'line_items': 'LineItems'},
+    'quotes': {'line_items': 'LineItems'},
+    'repeating_invoices': {'line_items': 'LineItems'},
+}
+
+# date field each endpoint can be filtered on with a `where` clause, for fetching in date windows
+DATE_FILTER_FIELDS = {
+    'bank_transactions': 'Date',
+    'bank_transfers': 'Date',
+    'credit_notes': 'Date',
+    'invoices': 'Date',
+    'manual_journals': 'Date',
+    'overpayments': 'Date',
+    'payments': 'Date',
+    'prepayments': 'Date',
+    'purchase_orders': 'Date',
+}
+
+def get_pipeline_config() -> Dict[str, Any]:
+    return {
+        "CDC_ENABLED": get_env_flag("CDC_ENABLED"),
+        "NORMALIZE_NESTED_ARRAYS": get_env_flag("NORMALIZE_NESTED_ARRAYS"),
+        "PAGE_SIZE": int(get_env_variable("BATCH_SIZE", "100")),
+        # bounds on the fetch -> transform -> sink pipeline; size the container to
+        # roughly PIPELINE_MAX_INFLIGHT_BYTES plus PIPELINE_SPOOL_MEMORY_BYTES per concurrent endpoint
+        "PIPELINE_MAX_CONCURRENT_ENDPOINTS": int(get_env_variable("PIPELINE_MAX_CONCURRENT_ENDPOINTS", "4")),
+        "PIPELINE_MAX_INFLIGHT_PAGES": int(get_env_variable("PIPELINE_MAX_INFLIGHT_PAGES", "8")),
+        "PIPELINE_MAX_INFLIGHT_BYTES": int(get_env_variable("PIPELINE_MAX_INFLIGHT_BYTES", str(64 * 1024 * 1024))),
+        "PIPELINE_SPOOL_MEMORY_BYTES": int(get_env_variable("PIPELINE_SPOOL_MEMORY_BYTES", str(16 * 1024 * 1024))),
+        "PIPELINE_SPOOL_DIR": os.environ.get("PIPELINE_SPOOL_DIR"),
+        # 0 keeps page transforms on threads; set to the number of cores on larger instances
+        "TRANSFORM_WORKERS": int(get_env_variable("TRANSFORM_WORKERS", "0")),
+        # Xero allows 5000 calls per tenant per day; QUOTA_SHARE is the fraction one run may use
+        "QUOTA_PLANNING": get_env_flag("QUOTA_PLANNING"),
+        "DAILY_CALL_LIMIT": int(get_env_variable("DAILY_CALL_LIMIT", "5000")),
+        "QUOTA_SHARE": float(get_env_variable("QUOTA_SHARE", "1.0")),
+        # set by Cloud Run for each task of a job execution
+        "SHARD_TASK_INDEX": int(get_env_variable("CLOUD_RUN_TASK_INDEX", "0")),
+        "SHARD_TASK_COUNT": int(get_env_variable("CLOUD_RUN_TASK_COUNT", "1")),
+        "SHARD_RUN_ID": os.environ.get("SHARD_RUN_ID") or os.environ.get("CLOUD_RUN_EXECUTION"),
+        "SHARD_PAGES_PER_UNIT": int(get_env_variable("SHARD_PAGES_PER_UNIT", "50")),
+        "SHARD_MANIFEST_DIR": os.environ.get("SHARD_MANIFEST_DIR"),
+        "DATE_WINDOWS_ENABLED": get_env_flag("DATE_WINDOWS_ENABLED"),
+        "DATE_WINDOW_START": get_env_variable("DATE_WINDOW_START", "2010-01-01"),
+        "DATE_WINDOW_MONTHS": int(get_env_variable("DATE_WINDOW_MONTHS", "12")),
+        "DATE_WINDOW_TARGET_PAGES": int(get_env_variable("DATE_WINDOW_TARGET_PAGES", "20")),
+        # reports are fetched for today and the month-ends before it; periods
+        # closed on or before the lock date are cached and never fetched again
+        "REPORT_PERIODS": int(get_env_variable("REPORT_PERIODS", "36")),
+        "REPORT_CLOSED_AFTER_DAYS": int(get_env_variable("REPORT_CLOSED_AFTER_DAYS", "45")),
+        "REPORT_LOCK_DATE": os.environ.get("REPORT_LOCK_DATE"),
+        # Xero allows 5 concurrent calls per tenant
+        "REPORT_MAX_CONCURRENT_FETCHES": min(int(get_env_variable("REPORT_MAX_CONCURRENT_FETCHES", "4")), 5),
+        # outputs of at least COMPOSITE_UPLOAD_THRESHOLD bytes are uploaded as parts over
+        # concurrent connections; each in-flight part is held in memory while it uploads
+        "COMPOSITE_UPLOAD_THRESHOLD": int(get_env_variable("COMPOSITE_UPLOAD_THRESHOLD", str(64 * 1024 * 1024))),
+        "COMPOSITE_UPLOAD_PART_SIZE": int(get_env_variable("COMPOSITE_UPLOAD_PART_SIZE", str(16 * 1024 * 1024))),
+        "COMPOSITE_UPLOAD_CONCURRENCY": int(get_env_variable("COMPOSITE_UPLOAD_CONCURRENCY", "8")),
+        # stores bucket objects under this directory instead of GCS, e.g. for local runs and tests
+        "LOCAL_STORAGE_DIR": os.environ.get("LOCAL_STORAGE_DIR"),
+        # opt-in profiling; artifacts go to PROFILE_DIR if set, otherwise to '_profiles/' in the bucket
+        "PROFILING": get_env_flag("PROFILING"),
+        "PROFILE_MODE": get_env_variable("PROFILE_MODE", "sampling"),
+        "PROFILE_MEMORY": get_env_flag("PROFILE_MEMORY", True),
+        "PROFILE_DIR": os.environ.get("PROFILE_DIR"),
+        # where the app credentials and tenant tokens live: 'secret_manager', or 'local'
+        # for a Fernet-encrypted file at TOKEN_STORE_PATH (development and benchmarking)
+        "TOKEN_STORE": get_env_variable("TOKEN_STORE", "secret_manager"),
+        "TOKEN_STORE_PATH": get_env_variable("TOKEN_STORE_PATH", "tokens.enc"),
+        "TOKEN_STORE_KEY": os.environ.get("TOKEN_STORE_KEY"),
+        # secret versions kept after a token refresh; older ones are destroyed
+        "TOKEN_VERSIONS_TO_KEEP": int(get_env_variable("TOKEN_VERSIONS_TO_KEEP", "2")),
+        # long-lived service mode (server.py); binds to localhost unless told otherwise
+        "SERVICE_HOST": get_env_variable("SERVICE_HOST", "127.0.0.1"),
+        "SERVICE_PORT": int(get_env_variable("SERVICE_PORT", "8080")),
+        "SERVICE_MAX_CONCURRENT_SYNCS": int(get_env_variable("SERVICE_MAX_CONCURRENT_SYNCS", "4")),
+        "SERVICE_API_KEY": os.environ.get("SERVICE_API_KEY"),
+        # retries of failed requests (429, 5xx, timeouts, truncated bodies) with jittered
+        # exponential backoff; RETRY_BUDGET caps the retries of a whole run
+        "RETRY_MAX_ATTEMPTS": int(get_env_variable("RETRY_MAX_ATTEMPTS", "5")),
+        "RETRY_BASE_SECONDS": float(get_env_variable("RETRY_BASE_SECONDS", "1")),
+        "RETRY_MAX_SECONDS": float(get_env_variable("RETRY_MAX_SECONDS", "60")),
+        "RETRY_BUDGET": int(get_env_variable("RETRY_BUDGET", "100")),
+        # a tenant whose requests keep failing is not called for CIRCUIT_RESET_SECONDS
+        "CIRCUIT_FAILURE_THRESHOLD": int(get_env_variable("CIRCUIT_FAILURE_THRESHOLD", "10")),
+        "CIRCUIT_RESET_SECONDS": float(get_env_variable("CIRCUIT_RESET_SECONDS", "60")),
+    }
+
+# settings overridden for the task (and the threads it starts) currently
+# working for another tenant than CLIENT_ID, see tenant_scope()
+_config_overrides: ContextVar[Dict[str, Any]] = ContextVar("config_overrides", default={})
+
+class ScopedConfig(dict):
+    """
+    the configuration dict; lookups return the current task's overrides where
+    there are any, so one process can sync several tenants at once
+    """
+
+    def __getitem__(self, key: str) -> Any:
+        overrides = _config_overrides.get()
+        if key in overrides:
+            return overrides[key]
+        return super().__getitem__(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+CONFIG = ScopedConfig({
     **get_client_config(),
+    **get_pipeline_config(),
     "ENDPOINTS": ENDPOINTS,
-}
\ No newline at end of file
+    "ENDPOINT_ID_FIELDS": ENDPOINT_ID_FIELDS,
+    "CDC_VOLATILE_FIELDS": CDC_VOLATILE_FIELDS,
+    "NESTED_ARRAYS": NESTED_ARRAYS,
+    "DATE_FILTER_FIELDS": DATE_FILTER_FIELDS,
+})
+
+@contextmanager
+def tenant_scope(client_id: str, **overrides: Any) -> Iterator[None]:
+    """
+    makes CONFIG describe another tenant, plus any further overrides, for the
+    current task and everything it runs through asyncio tasks or to_thread
+
+    threads started any other way (e.g. a ThreadPoolExecutor) do not inherit
+    the scope, so code running there must not read tenant settings from CONFIG
+    """
+    token = _config_overrides.set({
+        **get_tenant_config(client_id, CONFIG['PROJECT_NUMBER']),
+        **overrides,
+    })
+    try:
+        yield
+    finally:
+        _config_overrides.reset(token)
+
+def get_child_tables(name: str) -> Dict[str, str]:
+    """
+    returns the child tables an endpoint is normalized into, as
+    child output name -> nested array field, e.g. {'invoices__line_items': 'LineItems'}
+    """
+    if not CONFIG['NORMALIZE_NESTED_ARRAYS'] or name not in CONFIG['ENDPOINT_ID_FIELDS']:
+        return {}
+    return {
+        f"{name}__{child}": field
+        for child, field in CONFIG['NESTED_ARRAYS'].get(name, {}).items()
+    }
\ No newline at end of file
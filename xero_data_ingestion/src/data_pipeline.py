@@ -1,47 +1,523 @@
 import asyncio
-import json
-from datetime import datetime
-from typing import Tuple
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from config import CONFIG
-from api_client import fetch_data_from_endpoint
-from data_storage import write_json_to_gcs
+from config import CONFIG, get_child_tables
+from api_client import items_key_for, iter_pages
+from change_capture import ChangeTracker, index_file_name, parse_index, pending_index_file_name, serialize_index
+from date_windows import where_clause
+from data_storage import delete_gcs_file, read_json_from_gcs, write_file_to_gcs, write_json_to_gcs
+from flow_control import BudgetLease, ByteBudget
+from profiling import endpoint_scope, timed
+from quota_planner import save_run_stats
+from reports import is_report, process_report, promote_report_cache
+from retries import retry_budget_scope
+from transforms import encode_page, encode_records, hash_and_encode_page, tag_line
 from utils import get_logger
 
 logger = get_logger()
 
-async def process_endpoint(name_endpoint: Tuple[str, str]) -> None:
+# marks the end of a stream on the queues between pipeline stages
+_END_OF_STREAM = None
+
+# rough size of an encoded record, for checking the in-flight byte budget against the page size
+ESTIMATED_RECORD_BYTES = 4 * 1024
+
+# the worker pool for page transforms, if started, see start_transform_pool()
+_transform_pool: Optional[ProcessPoolExecutor] = None
+
+class WorkUnit(NamedTuple):
+    """
+    a range of one endpoint's pages or dates, processed as a single pipeline run
+
+    an endpoint that is not split is a single unit covering all of its pages
+    and writes '<output>.json'. units of a split endpoint each cover a page
+    range or a date window (ISO dates, half-open, None for unbounded) and
+    write '<output>/<part>.json', so they can run and be retried separately
+    """
+    name: str
+    endpoint: str
+    start_page: int = 1
+    end_page: Optional[int] = None
+    part: Optional[str] = None
+    window_start: Optional[str] = None
+    window_end: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}.{self.part.rsplit('/', 1)[-1]}" if self.part else self.name
+
+    @property
+    def where(self) -> Optional[str]:
+        if not self.part or not (self.window_start or self.window_end):
+            return None
+        window = tuple(date.fromisoformat(day) if day else None for day in (self.window_start, self.window_end))
+        return where_clause(CONFIG['DATE_FILTER_FIELDS'][self.name], window)
+
+def output_file_name(output_name: str, part: Optional[str] = None) -> str:
+    """
+    returns the bucket path an output of a work unit is written to
+    """
+    return f"{output_name}/{part}.json" if part else f"{output_name}.json"
+
+def load_change_tracker(bucket_name: str, name: str) -> Optional[ChangeTracker]:
+    """
+    returns a change tracker seeded with the previous run's hash index, or None
+    if change detection is disabled or the endpoint has no known ID field
     """
-    processes a single endpoint by fetching and storing its data
+    id_field = CONFIG['ENDPOINT_ID_FIELDS'].get(name)
+    if not CONFIG['CDC_ENABLED'] or not id_field:
+        return None
+    previous_index = parse_index(read_json_from_gcs(bucket_name, index_file_name(name)))
+    return ChangeTracker(id_field, previous_index)
+
+def save_change_tracker(bucket_name: str, name: str, tracker: ChangeTracker) -> None:
+    """
+    persists the hash index collected during this run as pending: the next run
+    only compares against it once the delta it describes is loaded, see
+    promote_pending_state()
+    """
+    content = serialize_index(tracker.id_field, tracker.index)
+    write_json_to_gcs(bucket_name, pending_index_file_name(name), content)
+
+def promote_change_index(bucket_name: str, name: str) -> None:
+    """
+    makes the pending hash index of an endpoint the one the next run compares against
+    """
+    if not CONFIG['CDC_ENABLED']:
+        return
+    content = read_json_from_gcs(bucket_name, pending_index_file_name(name))
+    if content is None:
+        return
+    write_json_to_gcs(bucket_name, index_file_name(name), content)
+    delete_gcs_file(bucket_name, pending_index_file_name(name))
+
+def promote_pending_state(bucket_name: str, names: List[str], failed_tables: List[str]) -> List[str]:
+    """
+    promotes the pending state of the endpoints whose tables all loaded
+
+    an endpoint with a table that failed to load keeps its previous hash index,
+    so the next run emits its inserts, updates and deletions again; a report
+    leaves the closed periods it fetched uncached, so the next run fetches them again
 
     Args:
-        name_endpoint (Tuple[str, str]): a tuple containing the endpoint name and URL
+        bucket_name (str): the client bucket
+        names (List[str]): the endpoints that were loaded
+        failed_tables (List[str]): the tables whose load failed, see load_json_to_table()
+
+    Returns:
+        List[str]: the endpoints whose tables all loaded
     """
-    name, endpoint = name_endpoint
-    client_id = CONFIG['CLIENT_ID']
-    bucket_name = CONFIG['BUCKET_NAME']
+    failed = set(failed_tables)
+    loaded = [name for name in names if not failed & {name, *get_child_tables(name)}]
+    for name in loaded:
+        if is_report(name):
+            promote_report_cache(bucket_name, name)
+        else:
+            promote_change_index(bucket_name, name)
+    return loaded
 
-    try:
-        all_data = await asyncio.to_thread(fetch_data_from_endpoint, endpoint, client_id)
+def select_changes(
+    hashed: List[Tuple[Optional[str], str, bytes, Dict[str, List[bytes]]]],
+    tracker: ChangeTracker,
+    output_name: str,
+) -> Dict[str, bytes]:
+    """
+    keeps only the records inserted or updated since the last run, tagged with
+    their operation; child rows are emitted with their parent and carry its operation
+    """
+    lines = {output_name: []}
+    for record_id, digest, line, child_lines in hashed:
+        operation = tracker.classify(record_id, digest)
+        if not operation:
+            continue
+        lines[output_name].append(tag_line(line, operation) + b"\n")
+        for child_name, child_records in child_lines.items():
+            lines.setdefault(child_name, []).extend(tag_line(child, operation) + b"\n" for child in child_records)
+    return {name: b"".join(output_lines) for name, output_lines in lines.items()}
+
+def build_tombstones(tracker: ChangeTracker, output_name: str, ingestion_time: str) -> Dict[str, bytes]:
+    """
+    encodes a delete record for every record missing since the last run; each
+    child table gets one delete per parent, standing for all of its child rows
+    """
+    tombstones = [{**tombstone, "ingestion_time": ingestion_time} for tombstone in tracker.tombstones()]
+    if not tombstones:
+        return {}
+    outputs = {output_name: encode_records(tombstones)}
+    for child_name in get_child_tables(output_name):
+        outputs[child_name] = outputs[output_name]
+    return outputs
+
+def chunk_size(chunk: Dict[str, bytes]) -> int:
+    return sum(len(content) for content in chunk.values())
 
-        if all_data:
-            ingestion_time = datetime.utcnow().isoformat()
-            # add ingestion_time to each record
-            json_lines = "\n".join(
-                json.dumps({**item, "ingestion_time": ingestion_time}) for item in all_data
+async def offload(executor: Optional[Executor], func: Callable, *args: Any) -> Any:
+    """
+    runs a CPU-bound transform in the worker pool if one is configured,
+    otherwise in a thread so the event loop stays responsive
+    """
+    if executor:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    return await asyncio.to_thread(func, *args)
+
+async def transform_page(
+    content: bytes,
+    name: str,
+    endpoint: str,
+    ingestion_time: str,
+    tracker: Optional[ChangeTracker],
+    executor: Optional[Executor],
+) -> Tuple[Dict[str, bytes], int]:
+    """
+    decodes a raw page, stamps its records with the ingestion time, explodes
+    configured nested arrays into child tables and encodes the records (or only
+    their changes) as NDJSON
+
+    Returns:
+        Tuple[Dict[str, bytes], int]: the encoded chunk per output (the endpoint
+        and its child tables) and the number of records on the page
+    """
+    items_key = items_key_for(endpoint)
+    children = get_child_tables(name)
+    # includes waiting for a worker; decode and serialize are only timed for in-process transforms
+    with timed('transform'):
+        if not tracker:
+            return await offload(
+                executor, encode_page,
+                content, items_key, ingestion_time, name, CONFIG['ENDPOINT_ID_FIELDS'].get(name), children,
             )
-            # write the data to Google Cloud Storage
-            await asyncio.to_thread(write_json_to_gcs, bucket_name, f"{name}.json", json_lines)
-            logger.info(f"processed endpoint '{name}' for client '{client_id}', total records: {len(all_data)}")
-        else:
-            logger.warning(f"no data found for endpoint '{name}' for client '{client_id}'")
+
+        hashed = await offload(
+            executor, hash_and_encode_page,
+            content, items_key, ingestion_time, tracker.id_field, CONFIG['CDC_VOLATILE_FIELDS'], children,
+        )
+        return select_changes(hashed, tracker, name), len(hashed)
+
+async def fetch_stage(
+    unit: WorkUnit,
+    client_id: str,
+    pages: asyncio.Queue,
+    lease: BudgetLease,
+    stats: Dict[str, int],
+) -> None:
+    """
+    fetches the unit's raw pages in order and hands them to the transform stage
+
+    if a page still fails after its retries, the stream ends there: the pages
+    fetched before it are transformed and stored as usual, and the failed page
+    is recorded in the stats under 'failed_at'
+    """
+    page_iterator = iter_pages(
+        unit.endpoint, client_id, CONFIG['PAGE_SIZE'], unit.start_page, unit.end_page, unit.where,
+    )
+    next_page = unit.start_page
+    try:
+        while True:
+            fetched = await asyncio.to_thread(next, page_iterator, None)
+            if fetched is None:
+                break
+            page, content = fetched
+            next_page = page + 1
+            stats['pages'] += 1
+            await lease.acquire(len(content))
+            await pages.put(content)
     except Exception as e:
-        logger.error(f"error processing endpoint '{name}' for client '{client_id}': {str(e)}")
+        logger.error(f"fetching '{unit.key}' for client '{client_id}' failed at page {next_page}: {str(e)}")
+        stats['failed_at'] = next_page
+    await pages.put(_END_OF_STREAM)
+
+async def transform_stage(
+    name: str,
+    endpoint: str,
+    ingestion_time: str,
+    tracker: Optional[ChangeTracker],
+    executor: Optional[Executor],
+    pages: asyncio.Queue,
+    chunks: asyncio.Queue,
+    lease: BudgetLease,
+    stats: Dict[str, int],
+    emit_tombstones: bool = True,
+) -> None:
+    """
+    turns raw pages into encoded NDJSON chunks (one per output) for the sink stage
+    """
+    while True:
+        content = await pages.get()
+        if content is _END_OF_STREAM:
+            break
+        chunk, record_count = await transform_page(content, name, endpoint, ingestion_time, tracker, executor)
+        stats['records'] += record_count
+        # the raw page's reservation becomes its encoded form's; releasing it and
+        # acquiring anew would let the fetch stages take the bytes and deadlock
+        await lease.resize(len(content), chunk_size(chunk))
+        if chunk_size(chunk):
+            await chunks.put(chunk)
+
+    # a unit covering only some pages (or cut short by a failed page) cannot tell
+    # a deleted record from one on a page it did not see
+    if tracker and emit_tombstones and 'failed_at' not in stats:
+        chunk = build_tombstones(tracker, name, ingestion_time)
+        if chunk:
+            # already in memory, so it is counted without waiting for room
+            await lease.resize(0, chunk_size(chunk))
+            await chunks.put(chunk)
+    await chunks.put(_END_OF_STREAM)
+
+def create_spool() -> tempfile.SpooledTemporaryFile:
+    return tempfile.SpooledTemporaryFile(
+        max_size=CONFIG['PIPELINE_SPOOL_MEMORY_BYTES'],
+        dir=CONFIG['PIPELINE_SPOOL_DIR'],
+    )
 
-async def run_pipeline() -> None:
+async def sink_stage(chunks: asyncio.Queue, spools: Dict[str, Any], lease: BudgetLease) -> None:
+    """
+    appends encoded chunks to one spool per output, each of which spills to
+    local disk once it outgrows its in-memory allowance
+    """
+    while True:
+        chunk = await chunks.get()
+        if chunk is _END_OF_STREAM:
+            break
+        for output_name, content in chunk.items():
+            if content:
+                await asyncio.to_thread(spools[output_name].write, content)
+        await lease.release(chunk_size(chunk))
+
+async def upload_spools(bucket_name: str, spools: Dict[str, Any], part: Optional[str] = None) -> None:
+    """
+    uploads each spooled output of a work unit to the bucket
+    """
+    for output_name, spool in spools.items():
+        await asyncio.to_thread(write_file_to_gcs, bucket_name, output_file_name(output_name, part), spool)
+
+async def run_stages(*stages) -> None:
+    """
+    runs pipeline stages concurrently, cancelling the rest as soon as one fails
+    """
+    tasks = [asyncio.create_task(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def process_endpoint(
+    unit: WorkUnit,
+    budget: ByteBudget,
+    limiter: asyncio.Semaphore,
+    executor: Optional[Executor] = None,
+    save_salvaged_index: bool = True,
+) -> Optional[Dict[str, Any]]:
+    """
+    processes a work unit of an endpoint by streaming its pages through the
+    fetch, transform and sink stages and storing the result
+
+    Args:
+        unit (WorkUnit): the endpoint and page range to process
+        budget (ByteBudget): the in-flight byte budget shared by all endpoints
+        limiter (asyncio.Semaphore): bounds how many endpoints are processed at once
+        executor (Optional[Executor]): worker pool for page transforms, if enabled
+        save_salvaged_index (bool): advance the hash index past the pages of a
+            salvaged unit; only safe when its output is loaded right after the run
+
+    Returns:
+        Optional[Dict[str, Any]]: run statistics of the unit, or None if it failed.
+        units of a split endpoint also return the hash index of the records they
+        saw under 'cdc_index', since only the complete set reveals deletions.
+        a unit whose pages were only partly fetched is stored as far as it got
+        and reports where it stopped under 'failed_at', see is_complete()
+    """
+    name = unit.name
+    client_id = CONFIG['CLIENT_ID']
+    bucket_name = CONFIG['BUCKET_NAME']
+
+    async with limiter:
+        with endpoint_scope(unit.key):
+            if is_report(name):
+                return await process_report(name, unit.endpoint)
+
+            lease = BudgetLease(budget)
+            # the endpoint itself plus any child tables its nested arrays are normalized into
+            spools = {output_name: create_spool() for output_name in [name, *get_child_tables(name)]}
+            try:
+                tracker = await asyncio.to_thread(load_change_tracker, bucket_name, name)
+                ingestion_time = datetime.utcnow().isoformat()
+                started = time.monotonic()
+                stats = {'pages': 0, 'records': 0}
+                pages = asyncio.Queue(maxsize=CONFIG['PIPELINE_MAX_INFLIGHT_PAGES'])
+                chunks = asyncio.Queue(maxsize=CONFIG['PIPELINE_MAX_INFLIGHT_PAGES'])
+
+                await run_stages(
+                    fetch_stage(unit, client_id, pages, lease, stats),
+                    transform_stage(
+                        name, unit.endpoint, ingestion_time, tracker, executor,
+                        pages, chunks, lease, stats, emit_tombstones=unit.part is None,
+                    ),
+                    sink_stage(chunks, spools, lease),
+                )
+
+                result = {}
+                if 'failed_at' in stats:
+                    if not stats['pages']:
+                        raise RuntimeError(f"no pages fetched before page {stats['failed_at']} failed")
+                    logger.warning(
+                        f"salvaged {stats['pages']} pages of '{unit.key}' for client '{client_id}' "
+                        f"before page {stats['failed_at']} failed"
+                    )
+                if tracker:
+                    # always overwrite the exports so an empty delta is not mistaken for the last one
+                    await upload_spools(bucket_name, spools, unit.part)
+                    if 'failed_at' in stats:
+                        # the records past the failed page keep their old digests until a complete run
+                        if not unit.part and save_salvaged_index:
+                            tracker.carry_over_unseen()
+                            await asyncio.to_thread(save_change_tracker, bucket_name, name, tracker)
+                    elif unit.part:
+                        result['cdc_index'] = tracker.index
+                    else:
+                        # the index is only saved once the delta it describes has been written
+                        await asyncio.to_thread(save_change_tracker, bucket_name, name, tracker)
+                    logger.info(
+                        f"processed endpoint '{name}' for client '{client_id}', total records: {stats['records']}, "
+                        f"changes: {tracker.counts}"
+                    )
+                else:
+                    # write the data to Google Cloud Storage, even if empty: the table loader
+                    # would otherwise load the previous run's export, and its wildcard for a
+                    # split endpoint needs every part
+                    await upload_spools(bucket_name, spools, unit.part)
+                    if stats['records']:
+                        logger.info(f"processed endpoint '{name}' for client '{client_id}', total records: {stats['records']}")
+                    else:
+                        logger.warning(f"no data found for endpoint '{name}' for client '{client_id}'")
+
+                return {
+                    **result,
+                    **stats,
+                    'seconds': round(time.monotonic() - started, 1),
+                    'completed_at': datetime.utcnow().isoformat(),
+                }
+            except Exception as e:
+                logger.error(f"error processing endpoint '{name}' for client '{client_id}': {str(e)}")
+                return None
+            finally:
+                for spool in spools.values():
+                    spool.close()
+                await lease.close()
+
+def is_complete(result: Optional[Dict[str, Any]]) -> bool:
+    """
+    returns True if a work unit (or report) was processed in full, rather than
+    failed or salvaged up to a failed page or report date
+    """
+    return isinstance(result, dict) and 'failed_at' not in result
+
+def check_pipeline_bounds() -> None:
+    """
+    checks the pipeline's bounds against each other before a run starts
+
+    a byte budget too small for the pages the concurrent endpoints can queue
+    is not a deadlock, but it runs the endpoints one page at a time
+    """
+    for key in ('PAGE_SIZE', 'PIPELINE_MAX_CONCURRENT_ENDPOINTS', 'PIPELINE_MAX_INFLIGHT_PAGES', 'PIPELINE_MAX_INFLIGHT_BYTES'):
+        if CONFIG[key] <= 0:
+            raise ValueError(f"{key} must be positive, got {CONFIG[key]}")
+
+    # each endpoint holds up to a full queue of pages and of chunks, plus the page in transform
+    queued_pages = CONFIG['PIPELINE_MAX_CONCURRENT_ENDPOINTS'] * (2 * CONFIG['PIPELINE_MAX_INFLIGHT_PAGES'] + 1)
+    needed = queued_pages * CONFIG['PAGE_SIZE'] * ESTIMATED_RECORD_BYTES
+    if CONFIG['PIPELINE_MAX_INFLIGHT_BYTES'] < needed:
+        logger.warning(
+            f"PIPELINE_MAX_INFLIGHT_BYTES of {CONFIG['PIPELINE_MAX_INFLIGHT_BYTES']} bytes holds fewer than the "
+            f"{queued_pages} pages of {CONFIG['PAGE_SIZE']} records the endpoints can queue (about {needed} bytes); "
+            f"fetching will wait on the budget. lower PIPELINE_MAX_CONCURRENT_ENDPOINTS, "
+            f"PIPELINE_MAX_INFLIGHT_PAGES or BATCH_SIZE, or raise the budget"
+        )
+
+def start_transform_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    starts the worker pool for page transforms when TRANSFORM_WORKERS is set;
+    call it once at startup, before the process starts threads or RPC clients.
+    every run reuses it, see stop_transform_pool()
+
+    workers are forked rather than spawned: spawning would re-import main.py and
+    with it the config module, which resolves the project over the network.
+    forking a process that runs threads or gRPC channels can deadlock the child,
+    so all workers are forked here, up front, and never again. the transforms
+    they run never touch the cloud clients inherited from the parent
+    """
+    global _transform_pool
+    workers = CONFIG['TRANSFORM_WORKERS']
+    if workers <= 0 or _transform_pool is not None:
+        return _transform_pool
+    logger.info(f"offloading page transforms to {workers} worker processes")
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    # a pool that forks starts all of its workers with its first task
+    pool.submit(int).result()
+    _transform_pool = pool
+    return pool
+
+def stop_transform_pool() -> None:
+    """
+    shuts the worker pool for page transforms down, if it was started
+    """
+    global _transform_pool
+    pool, _transform_pool = _transform_pool, None
+    if pool:
+        pool.shutdown(wait=True)
+
+async def run_work_units(units: List[WorkUnit], save_salvaged_index: bool = True) -> List[Optional[Dict[str, Any]]]:
+    """
+    runs work units concurrently within the pipeline's memory and concurrency bounds
+
+    Args:
+        units (List[WorkUnit]): the work units to run
+        save_salvaged_index (bool): advance the hash indexes of salvaged units, see
+            process_endpoint(). a sharded run passes False: it refetches a salvaged
+            unit whole and overwrites its output before loading, so an advanced
+            index would hide the salvaged pages' changes from that refetch
+
+    Returns:
+        List[Optional[Dict[str, Any]]]: the statistics of each unit, None for failed units
+        (salvaged units return statistics, see is_complete())
+    """
+    check_pipeline_bounds()
+    budget = ByteBudget(CONFIG['PIPELINE_MAX_INFLIGHT_BYTES'])
+    limiter = asyncio.Semaphore(CONFIG['PIPELINE_MAX_CONCURRENT_ENDPOINTS'])
+    # the units' tasks inherit the run's retry budget from this scope
+    with retry_budget_scope(CONFIG['RETRY_BUDGET']):
+        tasks = [process_endpoint(unit, budget, limiter, _transform_pool, save_salvaged_index) for unit in units]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    return [result if isinstance(result, dict) else None for result in results]
+
+async def run_pipeline(endpoints: Optional[Dict[str, str]] = None) -> Dict[str, Dict[str, Any]]:
     """
     runs the data ingestion pipeline concurrently for all endpoints
+
+    Args:
+        endpoints (Optional[Dict[str, str]]): endpoint name -> URL to run, defaults
+            to every configured endpoint
+
+    Returns:
+        Dict[str, Dict[str, Any]]: the statistics of the endpoints that stored their
+        output, including salvaged ones (see is_complete()); failed endpoints are left out
     """
-    endpoints = CONFIG['ENDPOINTS']
-    tasks = [process_endpoint(endpoint) for endpoint in endpoints.items()]
-    await asyncio.gather(*tasks, return_exceptions=True)
\ No newline at end of file
+    endpoints = endpoints if endpoints is not None else CONFIG['ENDPOINTS']
+    results = await run_work_units([WorkUnit(name, endpoint) for name, endpoint in endpoints.items()])
+    stored = {name: result for name, result in zip(endpoints.keys(), results) if result is not None}
+
+    # keep the history the quota planner estimates future runs from; salvaged
+    # endpoints do not count as completed, so the planner keeps them first in line
+    run_stats = {name: result for name, result in stored.items() if is_complete(result)}
+    try:
+        await asyncio.to_thread(save_run_stats, CONFIG['BUCKET_NAME'], run_stats)
+    except Exception as e:
+        logger.error(f"error saving run statistics: {str(e)}")
+    return stored
\ No newline at end of file
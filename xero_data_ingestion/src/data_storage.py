@@ -1,12 +1,136 @@
+import io
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
-from typing import Any
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from typing import IO, Any, List, Optional
 
+from config import CONFIG
+from local_storage import LocalBucket
+from profiling import timed
 from utils import get_logger
 
 logger = get_logger()
 
-# initialize storage client once
-storage_client = storage.Client()
+# initialize storage client once; a local storage directory needs no client
+storage_client = None if CONFIG['LOCAL_STORAGE_DIR'] else storage.Client()
+
+# GCS composes at most 32 source objects per request
+MAX_COMPOSE_SOURCES = 32
+
+# parts of composite uploads are staged under this prefix of the destination bucket
+COMPOSITE_PREFIX = "_tmp/composite"
+
+def get_bucket(bucket_name: str) -> Any:
+    """
+    returns a GCS bucket, or the directory standing in for it under
+    LOCAL_STORAGE_DIR if one is configured
+    """
+    if CONFIG['LOCAL_STORAGE_DIR']:
+        return LocalBucket(os.path.join(CONFIG['LOCAL_STORAGE_DIR'], bucket_name))
+    return storage_client.bucket(bucket_name)
+
+def file_size(file_obj: IO[bytes]) -> int:
+    file_obj.seek(0, os.SEEK_END)
+    return file_obj.tell()
+
+def upload_part(bucket: Any, part_name: str, file_obj: IO[bytes], offset: int, lock: threading.Lock) -> Any:
+    """
+    uploads `COMPOSITE_UPLOAD_PART_SIZE` bytes of a file from an offset as a separate object
+    """
+    with lock:
+        # parts share the file, so each seek and read must not interleave with another's
+        file_obj.seek(offset)
+        data = file_obj.read(CONFIG['COMPOSITE_UPLOAD_PART_SIZE'])
+    part = bucket.blob(part_name)
+    part.upload_from_string(data, content_type='application/json')
+    return part
+
+def compose_blobs(bucket: Any, file_name: str, sources: List[Any]) -> Any:
+    blob = bucket.blob(file_name)
+    blob.content_type = 'application/json'
+    blob.compose(sources)
+    return blob
+
+def delete_blob(blob: Any) -> None:
+    try:
+        blob.delete()
+    except NotFound:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to delete temporary object {blob.name}: {str(e)}")
+
+def collect_blobs(futures: List[Any], temporary: List[Any]) -> List[Any]:
+    """
+    waits for futures returning temporary objects, recording each one created
+    so it is cleaned up even if another future failed
+    """
+    blobs, error = [], None
+    for future in futures:
+        try:
+            blobs.append(future.result())
+        except Exception as e:
+            error = error or e
+    temporary.extend(blobs)
+    if error:
+        raise error
+    return blobs
+
+def composite_upload(bucket: Any, file_name: str, file_obj: IO[bytes], size: int) -> int:
+    """
+    uploads a file as parts over concurrent connections and composes them into
+    one object server-side, so a large upload is not limited to one stream
+
+    parts are composed in rounds of at most MAX_COMPOSE_SOURCES objects, keeping
+    their order, and every temporary object is deleted afterwards, also on failure
+
+    Returns:
+        int: the number of parts uploaded
+    """
+    part_size = CONFIG['COMPOSITE_UPLOAD_PART_SIZE']
+    prefix = f"{COMPOSITE_PREFIX}/{file_name}/{uuid.uuid4().hex}"
+    lock = threading.Lock()
+    temporary: List[Any] = []
+
+    with ThreadPoolExecutor(max_workers=CONFIG['COMPOSITE_UPLOAD_CONCURRENCY']) as executor:
+        try:
+            parts = collect_blobs([
+                executor.submit(upload_part, bucket, f"{prefix}/part-{index:05d}", file_obj, offset, lock)
+                for index, offset in enumerate(range(0, size, part_size))
+            ], temporary)
+            part_count = len(parts)
+
+            level = 0
+            while len(parts) > MAX_COMPOSE_SOURCES:
+                groups = [parts[start:start + MAX_COMPOSE_SOURCES] for start in range(0, len(parts), MAX_COMPOSE_SOURCES)]
+                parts = collect_blobs([
+                    executor.submit(compose_blobs, bucket, f"{prefix}/compose-{level}-{index:05d}", group)
+                    for index, group in enumerate(groups)
+                ], temporary)
+                level += 1
+
+            compose_blobs(bucket, file_name, parts)
+            return part_count
+        finally:
+            list(executor.map(delete_blob, temporary))
+
+def upload_file(bucket_name: str, file_name: str, file_obj: IO[bytes]) -> None:
+    """
+    uploads a file in one request, or as a composite upload if it reaches
+    COMPOSITE_UPLOAD_THRESHOLD bytes
+    """
+    bucket = get_bucket(bucket_name)
+    size = file_size(file_obj)
+    with timed('upload'):
+        if size >= CONFIG['COMPOSITE_UPLOAD_THRESHOLD']:
+            part_count = composite_upload(bucket, file_name, file_obj, size)
+            logger.info(f"Saved {file_name} to gs://{bucket_name}/{file_name} ({size} bytes in {part_count} parts)")
+        else:
+            blob = bucket.blob(file_name)
+            blob.upload_from_file(file_obj, rewind=True, content_type='application/json')
+            logger.info(f"Saved {file_name} to gs://{bucket_name}/{file_name}")
 
 def write_json_to_gcs(bucket_name: str, file_name: str, content: str) -> None:
     """
@@ -18,10 +142,90 @@ def write_json_to_gcs(bucket_name: str, file_name: str, content: str) -> None:
         content (str): The JSON content to write
     """
     try:
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
-        blob.upload_from_string(content, content_type='application/json')
-        logger.info(f"Saved {file_name} to gs://{bucket_name}/{file_name}")
+        upload_file(bucket_name, file_name, io.BytesIO(content.encode("UTF-8")))
+    except Exception as e:
+        logger.error(f"Failed to upload {file_name} to {bucket_name}: {str(e)}")
+        raise
+
+def write_file_to_gcs(bucket_name: str, file_name: str, file_obj: IO[bytes]) -> None:
+    """
+    uploads the content of an open file (from its start) to a specified GCS bucket
+
+    Args:
+        bucket_name (str): The name of the GCS bucket
+        file_name (str): The destination file name
+        file_obj (IO[bytes]): The file to upload, e.g. a spooled pipeline output
+    """
+    try:
+        upload_file(bucket_name, file_name, file_obj)
     except Exception as e:
         logger.error(f"Failed to upload {file_name} to {bucket_name}: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def read_json_from_gcs(bucket_name: str, file_name: str) -> Optional[str]:
+    """
+    reads JSON content from a specified GCS bucket
+
+    Args:
+        bucket_name (str): The name of the GCS bucket
+        file_name (str): The source file name
+
+    Returns:
+        Optional[str]: the file content, or None if the object does not exist
+    """
+    try:
+        bucket = get_bucket(bucket_name)
+        blob = bucket.blob(file_name)
+        return blob.download_as_text()
+    except NotFound:
+        logger.info(f"gs://{bucket_name}/{file_name} does not exist")
+        return None
+    except Exception as e:
+        logger.error(f"Failed to read {file_name} from {bucket_name}: {str(e)}")
+        raise
+
+def create_json_in_gcs(bucket_name: str, file_name: str, content: str) -> bool:
+    """
+    writes JSON content to a specified GCS bucket only if the object does not exist yet
+
+    Args:
+        bucket_name (str): The name of the GCS bucket
+        file_name (str): The destination file name
+        content (str): The JSON content to write
+
+    Returns:
+        bool: True if this call created the object, False if it already existed
+    """
+    try:
+        bucket = get_bucket(bucket_name)
+        blob = bucket.blob(file_name)
+        blob.upload_from_string(content, content_type='application/json', if_generation_match=0)
+        logger.info(f"Created gs://{bucket_name}/{file_name}")
+        return True
+    except PreconditionFailed:
+        return False
+    except Exception as e:
+        logger.error(f"Failed to create {file_name} in {bucket_name}: {str(e)}")
+        raise
+
+def list_gcs_files(bucket_name: str, prefix: str) -> List[str]:
+    """
+    lists the names of the objects under a prefix of a specified GCS bucket
+    """
+    try:
+        return [blob.name for blob in get_bucket(bucket_name).list_blobs(prefix=prefix)]
+    except Exception as e:
+        logger.error(f"Failed to list gs://{bucket_name}/{prefix}: {str(e)}")
+        raise
+
+def delete_gcs_file(bucket_name: str, file_name: str) -> None:
+    """
+    deletes an object from a specified GCS bucket, if it exists
+    """
+    try:
+        get_bucket(bucket_name).blob(file_name).delete()
+    except NotFound:
+        pass
+    except Exception as e:
+        logger.error(f"Failed to delete {file_name} from {bucket_name}: {str(e)}")
+        raise
@@ -0,0 +1,111 @@
+import math
+from datetime import date, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+# a half-open [start, end) date range; None leaves that side unbounded
+Window = Tuple[Optional[date], Optional[date]]
+
+def add_months(day: date, months: int) -> date:
+    """
+    returns the first day of the month `months` after the month of `day`
+    """
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def where_clause(field: str, window: Window) -> str:
+    """
+    returns the Xero `where` filter selecting records whose date field falls in a window
+    """
+    conditions = []
+    start, end = window
+    if start:
+        conditions.append(f"{field} >= DateTime({start.year}, {start.month:02d}, {start.day:02d})")
+    if end:
+        conditions.append(f"{field} < DateTime({end.year}, {end.month:02d}, {end.day:02d})")
+    return " && ".join(conditions)
+
+def window_label(window: Window) -> str:
+    start, end = window
+    return f"window-{start.strftime('%Y%m%d') if start else 'min'}-{end.strftime('%Y%m%d') if end else 'max'}"
+
+def estimate_pages(window: Window, history: Sequence[Tuple[Optional[str], Optional[str], int]]) -> Optional[float]:
+    """
+    estimates the pages in a bounded window from the windows of previous runs,
+    spreading each historical window's pages evenly over its days
+
+    Returns:
+        Optional[float]: the estimate, or None if no bounded historical window overlaps
+    """
+    start, end = window
+    if not start or not end:
+        return None
+    estimate, covered = 0.0, False
+    for history_start, history_end, pages in history:
+        if not history_start or not history_end:
+            continue
+        previous_start, previous_end = date.fromisoformat(history_start), date.fromisoformat(history_end)
+        overlap = (min(end, previous_end) - max(start, previous_start)).days
+        if overlap > 0:
+            estimate += pages * overlap / (previous_end - previous_start).days
+            covered = True
+    return estimate if covered else None
+
+def split_window(window: Window, parts: int) -> List[Window]:
+    """
+    splits a bounded window into `parts` windows of (nearly) equal length in days
+    """
+    start, end = window
+    days = (end - start).days
+    parts = max(1, min(parts, days))
+    bounds = [start + timedelta(days=days * index // parts) for index in range(parts)] + [end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def build_windows(
+    first_day: date,
+    today: date,
+    months_per_window: int,
+    target_pages: int,
+    history: Sequence[Tuple[Optional[str], Optional[str], int]] = (),
+) -> List[Window]:
+    """
+    covers all dates with windows sized to hold about `target_pages` pages each
+
+    starts from fixed windows of `months_per_window` months between `first_day`
+    and the current month, then uses the page counts of previous runs to split
+    windows denser than the target and merge runs of sparse neighbours. the
+    first window is unbounded below and the last unbounded above, so records
+    dated before `first_day` or in the future are still fetched
+
+    Args:
+        first_day (date): the first bounded window starts at the beginning of this month
+        today (date): the current date
+        months_per_window (int): length of the initial windows in months
+        target_pages (int): the pages a window should hold once its density is known
+        history (Sequence): [start, end, pages] of the windows of previous runs
+    """
+    current_month = add_months(today, 0)
+    windows: List[Window] = []
+    start = add_months(first_day, 0)
+    while start < current_month:
+        end = min(add_months(start, months_per_window), current_month)
+        pages = estimate_pages((start, end), history)
+        if pages is not None and pages > target_pages:
+            windows.extend(split_window((start, end), math.ceil(pages / target_pages)))
+        else:
+            windows.append((start, end))
+        start = end
+
+    merged: List[Window] = []
+    merged_pages: Optional[float] = None
+    for window in windows:
+        pages = estimate_pages(window, history)
+        if merged and merged_pages is not None and pages is not None and merged_pages + pages <= target_pages:
+            merged[-1] = (merged[-1][0], window[1])
+            merged_pages += pages
+        else:
+            merged.append(window)
+            merged_pages = pages
+
+    if not merged:
+        return [(None, None)]
+    return [(None, merged[0][0]), *merged, (merged[-1][1], None)]
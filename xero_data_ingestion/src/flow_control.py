@@ -0,0 +1,70 @@
+import asyncio
+
+
+class ByteBudget:
+    """
+    caps the number of bytes held in memory between pipeline stages
+
+    a single request larger than the whole budget is still granted once
+    nothing else is held, so one oversized page cannot deadlock the pipeline.
+    only the fetch stage waits for room: later stages resize what they already
+    hold, so the pages queued ahead of them can always drain
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.held = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> None:
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.held == 0 or self.held + size <= self.max_bytes
+            )
+            self.held += size
+
+    async def release(self, size: int) -> None:
+        async with self._condition:
+            self.held -= size
+            self._condition.notify_all()
+
+    async def resize(self, old_size: int, new_size: int) -> None:
+        """
+        turns a reservation of `old_size` bytes into one of `new_size` bytes
+        without waiting, e.g. a raw page into its encoded chunk
+
+        waiting here could deadlock: the bytes it waits for may be held by
+        pages queued behind the very stage that is waiting. growing may briefly
+        exceed the budget, which holds back the fetch stages until it drains
+        """
+        async with self._condition:
+            self.held += new_size - old_size
+            if new_size < old_size:
+                self._condition.notify_all()
+
+
+class BudgetLease:
+    """
+    tracks the share of a ByteBudget held by one endpoint so it can be
+    returned in full if the endpoint fails part-way through
+    """
+
+    def __init__(self, budget: ByteBudget):
+        self.budget = budget
+        self.held = 0
+
+    async def acquire(self, size: int) -> None:
+        await self.budget.acquire(size)
+        self.held += size
+
+    async def release(self, size: int) -> None:
+        self.held -= size
+        await self.budget.release(size)
+
+    async def resize(self, old_size: int, new_size: int) -> None:
+        self.held += new_size - old_size
+        await self.budget.resize(old_size, new_size)
+
+    async def close(self) -> None:
+        if self.held:
+            await self.release(self.held)
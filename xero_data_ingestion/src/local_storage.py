@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+from typing import IO, Iterator, List, Optional
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+class LocalBlob:
+    """
+    a file standing in for a GCS object, with the subset of the Blob API the
+    storage layer uses
+    """
+
+    def __init__(self, bucket: "LocalBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.content_type: Optional[str] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, self.name)
+
+    def _write(self, write, if_generation_match: Optional[int] = None) -> None:
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # write aside, then move into place so readers never see a partial object
+        with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".staged-", delete=False) as staged:
+            write(staged)
+        try:
+            if if_generation_match == 0:
+                try:
+                    os.link(staged.name, self.path)
+                except FileExistsError:
+                    raise PreconditionFailed(f"{self.name} already exists")
+            else:
+                os.replace(staged.name, self.path)
+        finally:
+            if os.path.exists(staged.name):
+                os.unlink(staged.name)
+
+    def upload_from_string(self, content, content_type: Optional[str] = None, if_generation_match: Optional[int] = None) -> None:
+        data = content.encode("UTF-8") if isinstance(content, str) else content
+        self._write(lambda staged: staged.write(data), if_generation_match)
+
+    def upload_from_file(self, file_obj: IO[bytes], rewind: bool = False, content_type: Optional[str] = None) -> None:
+        if rewind:
+            file_obj.seek(0)
+        self._write(lambda staged: shutil.copyfileobj(file_obj, staged))
+
+    def download_as_text(self) -> str:
+        try:
+            with open(self.path, encoding="UTF-8") as source:
+                return source.read()
+        except FileNotFoundError:
+            raise NotFound(f"{self.name} does not exist")
+
+    def compose(self, sources: List["LocalBlob"]) -> None:
+        def concatenate(staged):
+            for source in sources:
+                with open(source.path, "rb") as part:
+                    shutil.copyfileobj(part, staged)
+        self._write(concatenate)
+
+    def delete(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            raise NotFound(f"{self.name} does not exist")
+
+class LocalBucket:
+    """
+    a directory standing in for a GCS bucket, for running the pipeline and
+    exercising the storage layer without GCS
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix: str = "") -> Iterator[LocalBlob]:
+        for path, _, file_names in os.walk(self.root):
+            for file_name in sorted(file_names):
+                if file_name.startswith(".staged-"):
+                    continue
+                name = os.path.relpath(os.path.join(path, file_name), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    yield LocalBlob(self, name)
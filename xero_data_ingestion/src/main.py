@@ -1,23 +1,162 @@
+import argparse
 import asyncio
-from data_pipeline import run_pipeline
+import io
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+from authentication import preload_secrets
+from config import CONFIG
+from data_pipeline import is_complete, promote_pending_state, run_pipeline, start_transform_pool, stop_transform_pool
+from data_storage import write_file_to_gcs
+from profiling import Profile, phase, start_profile, stop_profile, timed
+from quota_planner import build_plan
+from sharding import run_sharded, work_unit_endpoints
 from table_loader import load_json_to_table
 from utils import get_logger
 
 logger = get_logger()
 
+# profiling artifacts are written under this prefix of the client bucket
+PROFILE_PREFIX = "_profiles"
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="ingests Xero data into GCS and BigQuery")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        default=CONFIG['QUOTA_PLANNING'],
+        help="only run the endpoints that fit this run's share of the daily API quota",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print the quota plan for this run and exit without fetching any data",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=CONFIG['PROFILING'],
+        help="profile this run and write a per-stage timing report and call profiles",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=CONFIG['PROFILE_DIR'],
+        help="write profiling artifacts to this local directory instead of the bucket",
+    )
+    return parser.parse_args()
+
+def save_profile(profile: Profile, directory: Optional[str] = None) -> None:
+    """
+    writes the timing report and call profiles of a run to a local directory,
+    or to '_profiles/<run>/' in the client bucket
+    """
+    label = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-task{CONFIG['SHARD_TASK_INDEX']}"
+    artifacts = {
+        'stages.json': json.dumps(profile.report(), indent=2).encode("UTF-8"),
+        **profile.artifacts,
+    }
+    for file_name, content in artifacts.items():
+        if directory:
+            os.makedirs(os.path.join(directory, label), exist_ok=True)
+            with open(os.path.join(directory, label, file_name), "wb") as artifact:
+                artifact.write(content)
+        else:
+            write_file_to_gcs(CONFIG['BUCKET_NAME'], f"{PROFILE_PREFIX}/{label}/{file_name}", io.BytesIO(content))
+    location = os.path.join(directory, label) if directory else f"gs://{CONFIG['BUCKET_NAME']}/{PROFILE_PREFIX}/{label}"
+    logger.info(f"saved profile of this run to {location}")
+
+def load_tables(endpoints: Dict[str, str]) -> List[str]:
+    """
+    loads the outputs of the endpoints into BigQuery, profiled as the 'load' phase,
+    and promotes the pending state of the endpoints that loaded
+
+    Returns:
+        List[str]: the endpoints whose tables all loaded
+    """
+    with phase('load'):
+        failed_tables = load_json_to_table(endpoints)
+    return promote_pending_state(CONFIG['BUCKET_NAME'], list(endpoints), failed_tables)
+
+async def ingest(endpoints: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    fetches endpoints of the current tenant into GCS and loads them into BigQuery
+
+    endpoints run as work units (see sharding.run_sharded()) only if they have
+    to; the others are loaded first, so a work unit that fails and raises never
+    holds back their load
+
+    Args:
+        endpoints (Dict[str, str]): endpoint name -> URL to run
+
+    Returns:
+        Dict[str, List[str]]: the names of the endpoints that 'completed' and that 'failed'
+    """
+    logger.info("starting data ingestion and loading pipeline")
+    sharded = work_unit_endpoints(endpoints)
+    unsharded = {name: endpoint for name, endpoint in endpoints.items() if name not in sharded}
+    result = {'completed': [], 'failed': []}
+
+    if unsharded:
+        with phase('pipeline'):
+            results = await run_pipeline(unsharded)
+        # endpoints that failed outright wrote nothing, so loading them would append
+        # the previous run's output again; salvaged endpoints are loaded as far as they got.
+        # waiting on the load jobs in a thread keeps the event loop free for other syncs
+        loaded = await asyncio.to_thread(load_tables, {name: unsharded[name] for name in results})
+        for name in unsharded:
+            result['completed' if name in loaded and is_complete(results[name]) else 'failed'].append(name)
+
+    if sharded:
+        # the task that finishes the last work unit also loads BigQuery; failed units raise
+        with phase('work_units'):
+            finalized = await run_sharded(sharded)
+        if finalized:
+            logger.info(f"loaded the work units of {', '.join(sharded)}")
+        result['completed'].extend(sharded)
+
+    if result['failed']:
+        logger.warning(f"pipeline completed with failed endpoints: {', '.join(result['failed'])}")
+    else:
+        logger.info("pipeline completed successfully and BigQuery tables created")
+    return result
+
 async def main():
     """
     runs the data ingestion and loading pipeline
     """
+    args = parse_args()
+    # transform workers are forked before the profiler's thread, the thread pool
+    # and the first RPC of this process
+    start_transform_pool()
+    profile = start_profile(CONFIG['PROFILE_MODE'], CONFIG['PROFILE_MEMORY']) if args.profile else None
     try:
-        logger.info("starting data ingestion and loading pipeline")
-        await run_pipeline()
-        load_json_to_table()
-        logger.info("pipeline completed successfully and BigQuery tables created")
+        # one concurrent batch of secret reads instead of one per first use
+        with timed('auth'):
+            await asyncio.to_thread(preload_secrets, [CONFIG['CLIENT_ID']])
+
+        endpoints = CONFIG['ENDPOINTS']
+        if args.plan or args.dry_run:
+            plan = await asyncio.to_thread(build_plan, endpoints)
+            if args.dry_run:
+                print(json.dumps(plan, indent=2))
+                return
+            endpoints = {name: endpoints[name] for name in plan['run']}
+
+        await ingest(endpoints)
     except Exception as e:
         error_message = f"pipeline error: {str(e)}"
         logger.error(error_message)
         raise
+    finally:
+        stop_transform_pool()
+        # a failed run is profiled too; that is often the one worth diagnosing
+        if profile:
+            stop_profile()
+            try:
+                save_profile(profile, args.profile_dir)
+            except Exception as e:
+                logger.error(f"error saving profile: {str(e)}")
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
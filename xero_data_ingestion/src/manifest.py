@@ -0,0 +1,111 @@
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+from data_storage import create_json_in_gcs, list_gcs_files, read_json_from_gcs
+from utils import get_logger
+
+logger = get_logger()
+
+# run-scoped coordination state lives under this prefix of the client bucket
+MANIFEST_PREFIX = "_runs"
+
+class ManifestStore(ABC):
+    """
+    write-once key/value store shared by every task of a run
+
+    create() is atomic and never overwrites, so it doubles as a claim: of
+    several tasks creating the same entry, exactly one succeeds
+    """
+
+    @abstractmethod
+    def create(self, name: str, content: str) -> bool:
+        """
+        writes an entry unless it exists
+
+        Returns:
+            bool: True if this call created the entry
+        """
+
+    @abstractmethod
+    def read(self, name: str) -> Optional[str]:
+        """
+        returns the content of an entry, or None if it does not exist
+        """
+
+    @abstractmethod
+    def list(self, prefix: str) -> List[str]:
+        """
+        returns the names of the entries starting with `prefix`, sorted
+        """
+
+class GcsManifestStore(ManifestStore):
+    """
+    keeps the manifest of a run under '_runs/<run id>/' in the client bucket
+    """
+
+    def __init__(self, bucket_name: str, run_id: str):
+        self.bucket_name = bucket_name
+        self.prefix = f"{MANIFEST_PREFIX}/{run_id}/"
+
+    def create(self, name: str, content: str) -> bool:
+        return create_json_in_gcs(self.bucket_name, self.prefix + name, content)
+
+    def read(self, name: str) -> Optional[str]:
+        return read_json_from_gcs(self.bucket_name, self.prefix + name)
+
+    def list(self, prefix: str) -> List[str]:
+        names = list_gcs_files(self.bucket_name, self.prefix + prefix)
+        return sorted(name[len(self.prefix):] for name in names)
+
+class LocalManifestStore(ManifestStore):
+    """
+    keeps the manifest of a run in a directory shared by all tasks, e.g. a
+    mounted volume, for running shards locally
+    """
+
+    def __init__(self, directory: str, run_id: str):
+        self.root = os.path.join(directory, run_id)
+
+    def create(self, name: str, content: str) -> bool:
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write aside, then link into place: linking fails if the entry exists,
+        # and readers never see a partially written entry
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), prefix=".staged-", delete=False) as staged:
+            staged.write(content)
+        try:
+            os.link(staged.name, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(staged.name)
+
+    def read(self, name: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.root, name)) as entry:
+                return entry.read()
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix: str) -> List[str]:
+        directory = os.path.join(self.root, prefix)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            os.path.relpath(os.path.join(path, file_name), self.root)
+            for path, _, file_names in os.walk(directory)
+            for file_name in file_names
+            if not file_name.startswith(".staged-")
+        )
+
+def get_manifest_store(bucket_name: str, run_id: str, directory: Optional[str] = None) -> ManifestStore:
+    """
+    returns the local manifest store if a shared directory is configured,
+    otherwise the one in the client bucket
+    """
+    if directory:
+        return LocalManifestStore(directory, run_id)
+    return GcsManifestStore(bucket_name, run_id)
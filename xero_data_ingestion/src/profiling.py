@@ -0,0 +1,262 @@
+import cProfile
+import contextvars
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+# this module is imported by the transforms that run in worker processes, so
+# like them it must stay free of cloud clients
+
+# stages of the per-stage timing breakdown, in pipeline order
+STAGES = ("auth", "fetch", "transform", "decode", "serialize", "upload", "load")
+
+# how often the sampler records the stacks of all threads and the traced memory
+SAMPLE_INTERVAL_SECONDS = 0.01
+
+# the endpoint (or work unit) the current task or thread is working for
+_current_endpoint: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_endpoint", default=None)
+
+# the profile of this run, if profiling is enabled
+_active: Optional["Profile"] = None
+
+class Profile:
+    """
+    collects the profile of one run: wall time per stage and endpoint, call
+    stacks of the profiled phases and per-endpoint memory peaks
+
+    Args:
+        mode (str): 'sampling' samples the stacks of every thread, which covers
+            the work the pipeline runs in threads; 'cprofile' traces every call,
+            but only on the event loop's thread; 'none' only records timings
+        memory (bool): track allocations with tracemalloc
+    """
+
+    def __init__(self, mode: str = "sampling", memory: bool = True):
+        self.mode = mode
+        self.memory = memory
+        self.pid = os.getpid()
+        self.started_at = datetime.utcnow().isoformat()
+        self.stages: Dict[str, Dict[str, Dict[str, float]]] = {}
+        self.phases: Dict[str, float] = {}
+        self.endpoints: Dict[str, Dict[str, int]] = {}
+        self.artifacts: Dict[str, bytes] = {}
+        self.peak_traced_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+        self._samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.memory:
+            tracemalloc.start()
+        if self.mode == "sampling" or self.memory:
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        if self.memory:
+            self.peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def record(self, stage: str, endpoint: Optional[str], seconds: float) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(endpoint or "_run", {}).setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+
+    def _sample(self) -> None:
+        """
+        records the stacks of every other thread and attributes the traced
+        memory to the endpoints currently running, until stopped
+        """
+        own_thread = threading.get_ident()
+        while not self._stop.wait(SAMPLE_INTERVAL_SECONDS):
+            if self.memory:
+                traced = tracemalloc.get_traced_memory()[0]
+                with self._lock:
+                    for usage in self.endpoints.values():
+                        if usage['active']:
+                            usage['peak_traced_bytes'] = max(usage['peak_traced_bytes'], traced)
+            if self.mode != "sampling":
+                continue
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self._samples.update(stacks)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        profiles a phase of the run (e.g. the pipeline or the BigQuery load) and
+        keeps its call profile as an artifact
+        """
+        profiler = cProfile.Profile() if self.mode == "cprofile" else None
+        with self._lock:
+            samples_before = Counter(self._samples)
+        started = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            self.phases[name] = round(time.perf_counter() - started, 3)
+            if profiler:
+                summary = io.StringIO()
+                pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(50)
+                # the format pstats and snakeviz load
+                profiler.create_stats()
+                self.artifacts[f"{name}.prof"] = marshal.dumps(profiler.stats)
+                self.artifacts[f"{name}_cprofile.txt"] = summary.getvalue().encode("UTF-8")
+            elif self.mode == "sampling":
+                # folded stacks, as read by flamegraph.pl and speedscope
+                with self._lock:
+                    samples = Counter(self._samples)
+                samples.subtract(samples_before)
+                folded = "".join(f"{stack} {count}\n" for stack, count in samples.most_common() if count > 0)
+                self.artifacts[f"{name}_samples.folded"] = folded.encode("UTF-8")
+
+    def report(self) -> Dict[str, Any]:
+        """
+        returns the timing breakdown of the run, per endpoint and in total
+
+        stage seconds are summed over calls, so stages running concurrently
+        (e.g. the pages of several endpoints) can add up to more than the wall time
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+        for stages in self.stages.values():
+            for stage, entry in stages.items():
+                total = totals.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+                total['seconds'] += entry['seconds']
+                total['calls'] += entry['calls']
+
+        def rounded(stages: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+            order = {stage: index for index, stage in enumerate(STAGES)}
+            return {
+                stage: {'seconds': round(entry['seconds'], 3), 'calls': entry['calls']}
+                for stage, entry in sorted(stages.items(), key=lambda item: order.get(item[0], len(order)))
+            }
+
+        report = {
+            'started_at': self.started_at,
+            'mode': self.mode,
+            'phases': self.phases,
+            'stages': rounded(totals),
+            'endpoints': {endpoint: rounded(stages) for endpoint, stages in sorted(self.stages.items())},
+        }
+        if self.memory:
+            report['memory'] = {
+                'peak_traced_bytes': self.peak_traced_bytes,
+                # peaks are of the whole process while the endpoint ran, so they include
+                # endpoints running alongside it; run with PIPELINE_MAX_CONCURRENT_ENDPOINTS=1
+                # to isolate them
+                'endpoints': {
+                    endpoint: {
+                        'peak_traced_bytes': usage['peak_traced_bytes'],
+                        'traced_bytes_at_start': usage['traced_bytes_at_start'],
+                    }
+                    for endpoint, usage in sorted(self.endpoints.items())
+                },
+            }
+        return report
+
+def start_profile(mode: str = "sampling", memory: bool = True) -> Profile:
+    """
+    starts profiling this run; timers and scopes are no-ops until this is called
+    """
+    global _active
+    _active = Profile(mode, memory)
+    _active.start()
+    return _active
+
+def stop_profile() -> Optional[Profile]:
+    """
+    stops profiling and returns the finished profile, if one was running
+    """
+    global _active
+    profile, _active = _active, None
+    if profile:
+        profile.stop()
+    return profile
+
+def active_profile() -> Optional[Profile]:
+    """
+    returns the running profile, but never inside a forked worker process,
+    which inherits a copy that is never reported
+    """
+    if _active is None or _active.pid != os.getpid():
+        return None
+    return _active
+
+@contextmanager
+def timed(stage: str, endpoint: Optional[str] = None) -> Iterator[None]:
+    """
+    adds the wall time of the enclosed block to a stage of the running profile,
+    under the given endpoint or the one the current task is working for
+    """
+    profile = active_profile()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record(stage, endpoint or _current_endpoint.get(), time.perf_counter() - started)
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    profiles a phase of the run if profiling is enabled
+    """
+    profile = active_profile()
+    if profile is None:
+        yield
+        return
+    with profile.phase(name):
+        yield
+
+@contextmanager
+def endpoint_scope(endpoint: str) -> Iterator[None]:
+    """
+    attributes the stage timings and memory of the enclosed block, including
+    threads it starts with asyncio.to_thread, to an endpoint
+    """
+    profile = active_profile()
+    if profile is None:
+        yield
+        return
+    token = _current_endpoint.set(endpoint)
+    with profile._lock:
+        traced = tracemalloc.get_traced_memory()[0] if profile.memory else 0
+        usage = profile.endpoints.setdefault(
+            endpoint, {'peak_traced_bytes': traced, 'traced_bytes_at_start': traced, 'active': 0},
+        )
+        usage['active'] += 1
+    try:
+        yield
+    finally:
+        with profile._lock:
+            usage['active'] -= 1
+        _current_endpoint.reset(token)
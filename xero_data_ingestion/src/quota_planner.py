@@ -0,0 +1,163 @@
+import json
+import math
+import time
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+from api_client import RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD, fetch_page, rate_limits
+from config import CONFIG, ENDPOINT_BASE
+from data_storage import read_json_from_gcs, write_json_to_gcs
+from date_windows import Window, build_windows, estimate_pages
+from reports import is_report, uncached_dates
+from utils import get_logger
+
+logger = get_logger()
+
+# per-endpoint statistics of completed runs, used to estimate the next one
+RUN_STATS_FILE = "_state/run_stats.json"
+
+# cost assumed for endpoints that have never completed a run
+DEFAULT_PAGES = 1
+
+def load_run_stats(bucket_name: str) -> Dict[str, Dict[str, Any]]:
+    """
+    retrieves the statistics recorded by previous runs, keyed by endpoint name
+    """
+    content = read_json_from_gcs(bucket_name, RUN_STATS_FILE)
+    return json.loads(content) if content else {}
+
+def save_run_stats(bucket_name: str, run_stats: Dict[str, Dict[str, Any]]) -> None:
+    """
+    merges the statistics of this run's completed endpoints into the persisted ones
+    """
+    if not run_stats:
+        return
+    merged = {**load_run_stats(bucket_name), **run_stats}
+    write_json_to_gcs(bucket_name, RUN_STATS_FILE, json.dumps(merged, indent=2, sort_keys=True))
+
+def probe_day_remaining(client_id: str) -> Optional[int]:
+    """
+    returns the calls left in the client's daily quota, spending one cheap
+    request if no response in this process has reported it yet
+    """
+    if 'day_remaining' not in rate_limits.get(client_id, {}):
+        try:
+            fetch_page(ENDPOINT_BASE + 'Organisation', client_id, 1)
+        except Exception as e:
+            logger.warning(f"could not probe rate limits for client {client_id}: {str(e)}")
+    return rate_limits.get(client_id, {}).get('day_remaining')
+
+def uses_date_windows(name: str) -> bool:
+    return CONFIG['DATE_WINDOWS_ENABLED'] and name in CONFIG['DATE_FILTER_FIELDS']
+
+def plan_windows(previous: Dict[str, Any]) -> List[Window]:
+    """
+    returns the date windows an endpoint is fetched in, sized from the page
+    counts its windows had in its last completed run
+    """
+    return build_windows(
+        date.fromisoformat(CONFIG['DATE_WINDOW_START']),
+        datetime.utcnow().date(),
+        CONFIG['DATE_WINDOW_MONTHS'],
+        CONFIG['DATE_WINDOW_TARGET_PAGES'],
+        previous.get('windows', []),
+    )
+
+def estimate_endpoint(name: str, history: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    estimates the requests and wall time an endpoint needs from its last completed run
+
+    an endpoint fetched in date windows costs at least one call per window,
+    even for windows that turn out to be empty, and a report one call per
+    period that is not cached
+    """
+    previous = history.get(name, {})
+    calls = previous.get('pages', DEFAULT_PAGES)
+    if is_report(name):
+        calls = len(uncached_dates(CONFIG['BUCKET_NAME'], name, datetime.utcnow().date()))
+    elif uses_date_windows(name):
+        window_calls = sum(
+            max(math.ceil(estimate_pages(window, previous.get('windows', [])) or DEFAULT_PAGES), 1)
+            for window in plan_windows(previous)
+        )
+        calls = max(calls, window_calls)
+    seconds = previous.get('seconds', calls * RATE_LIMIT_PERIOD / RATE_LIMIT_CALLS)
+    return {
+        'calls': calls,
+        'seconds': round(seconds, 1),
+        'last_completed_at': previous.get('completed_at'),
+    }
+
+def plan_run(
+    endpoints: Dict[str, str],
+    history: Dict[str, Dict[str, Any]],
+    day_remaining: Optional[int],
+) -> Dict[str, Any]:
+    """
+    picks the endpoints that fit this run's share of the daily call quota
+
+    endpoints that have waited longest since their last completed run go
+    first, so anything deferred now is first in line on the next run. an
+    endpoint that alone exceeds the run budget is deferred and flagged rather
+    than started, since a run cut off by the daily limit wastes every call
+    it already made
+
+    Args:
+        endpoints (Dict[str, str]): endpoint name -> URL of the candidate endpoints
+        history (Dict[str, Dict[str, Any]]): statistics of previous runs
+        day_remaining (Optional[int]): calls left today as reported by Xero, if known
+
+    Returns:
+        Dict[str, Any]: the budget, the endpoints to run and defer with their
+        estimates, and the estimated calls and wall time of the run
+    """
+    budget = int(CONFIG['DAILY_CALL_LIMIT'] * CONFIG['QUOTA_SHARE'])
+    if day_remaining is not None:
+        budget = min(budget, day_remaining)
+
+    estimates = {name: estimate_endpoint(name, history) for name in endpoints}
+    # never-completed endpoints sort first, then the least recently completed
+    order = sorted(estimates, key=lambda name: estimates[name]['last_completed_at'] or '')
+
+    selected, deferred = {}, {}
+    planned_calls = 0
+    for name in order:
+        estimate = estimates[name]
+        if estimate['calls'] > budget:
+            deferred[name] = {**estimate, 'reason': 'exceeds the whole run budget'}
+        elif planned_calls + estimate['calls'] > budget:
+            deferred[name] = {**estimate, 'reason': 'quota share exhausted'}
+        else:
+            selected[name] = estimate
+            planned_calls += estimate['calls']
+
+    # endpoints run concurrently but share one rate limit, so the run takes
+    # at least as long as its slowest endpoint and as its total call count allows
+    rate_bound_seconds = planned_calls * RATE_LIMIT_PERIOD / RATE_LIMIT_CALLS
+    slowest_seconds = max((estimate['seconds'] for estimate in selected.values()), default=0)
+
+    return {
+        'planned_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'budget_calls': budget,
+        'day_remaining': day_remaining,
+        'planned_calls': planned_calls,
+        'estimated_seconds': round(max(rate_bound_seconds, slowest_seconds), 1),
+        'run': selected,
+        'deferred': deferred,
+    }
+
+def build_plan(endpoints: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    plans a run for the configured client from its history and current quota
+    """
+    endpoints = endpoints if endpoints is not None else CONFIG['ENDPOINTS']
+    history = load_run_stats(CONFIG['BUCKET_NAME'])
+    day_remaining = probe_day_remaining(CONFIG['CLIENT_ID'])
+    plan = plan_run(endpoints, history, day_remaining)
+    for name, estimate in plan['deferred'].items():
+        logger.warning(f"deferring endpoint '{name}' ({estimate['calls']} calls): {estimate['reason']}")
+    logger.info(
+        f"planned {len(plan['run'])} endpoints, {plan['planned_calls']} calls of a "
+        f"{plan['budget_calls']} call budget, ~{plan['estimated_seconds']}s"
+    )
+    return plan
@@ -0,0 +1,242 @@
+import asyncio
+import itertools
+import json
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from api_client import fetch_report
+from config import CONFIG
+from data_storage import delete_gcs_file, list_gcs_files, read_json_from_gcs, write_json_to_gcs
+from transforms import encode_records
+from utils import get_logger
+
+logger = get_logger()
+
+REPORT_PREFIX = "reports__"
+
+# flattened reports of closed periods, which never change once closed, and
+# those fetched by a run whose output is not loaded yet
+CACHE_PREFIX = "_cache/reports"
+PENDING_CACHE_PREFIX = "_cache/reports_pending"
+
+def is_report(name: str) -> bool:
+    return name.startswith(REPORT_PREFIX)
+
+def report_dates(today: date, periods: int) -> List[date]:
+    """
+    returns today and the month-ends of the `periods - 1` months before it, oldest first
+    """
+    dates = [today]
+    month_start = today.replace(day=1)
+    for _ in range(periods - 1):
+        month_end = month_start - timedelta(days=1)
+        dates.append(month_end)
+        month_start = month_end.replace(day=1)
+    return sorted(dates)
+
+def closed_until(today: date) -> date:
+    """
+    returns the last date whose figures can no longer change: the configured
+    lock date, or REPORT_CLOSED_AFTER_DAYS before today
+    """
+    if CONFIG['REPORT_LOCK_DATE']:
+        return date.fromisoformat(CONFIG['REPORT_LOCK_DATE'])
+    return today - timedelta(days=CONFIG['REPORT_CLOSED_AFTER_DAYS'])
+
+def report_params(name: str, report_date: date) -> Dict[str, str]:
+    """
+    returns the query parameters that select a report as of a date
+    """
+    if name == 'reports__bank_summary':
+        # bank summary covers a period rather than a point in time; use the month to date
+        return {'fromDate': report_date.replace(day=1).isoformat(), 'toDate': report_date.isoformat()}
+    return {'date': report_date.isoformat()}
+
+def cache_file_name(name: str, report_date: date, prefix: str = CACHE_PREFIX) -> str:
+    return f"{prefix}/{name}/{report_date.isoformat()}.json"
+
+def cached_dates(bucket_name: str, name: str) -> List[date]:
+    """
+    returns the dates of a report's closed periods that are cached, and so loaded
+    """
+    prefix = f"{CACHE_PREFIX}/{name}/"
+    return [
+        date.fromisoformat(file_name[len(prefix):-len(".json")])
+        for file_name in list_gcs_files(bucket_name, prefix)
+    ]
+
+def uncached_dates(bucket_name: str, name: str, today: date) -> List[date]:
+    """
+    returns the dates of the REPORT_PERIODS series a run has to fetch: the open
+    periods and the closed ones not cached yet
+    """
+    last_closed = closed_until(today)
+    cached = set(cached_dates(bucket_name, name))
+    return [
+        report_date
+        for report_date in report_dates(today, CONFIG['REPORT_PERIODS'])
+        if report_date > last_closed or report_date not in cached
+    ]
+
+def promote_report_cache(bucket_name: str, name: str) -> None:
+    """
+    caches the closed periods a run fetched once its output is loaded, so they
+    are neither fetched nor loaded again
+    """
+    prefix = f"{PENDING_CACHE_PREFIX}/{name}/"
+    for file_name in list_gcs_files(bucket_name, prefix):
+        content = read_json_from_gcs(bucket_name, file_name)
+        write_json_to_gcs(bucket_name, f"{CACHE_PREFIX}/{name}/{file_name[len(prefix):]}", content)
+        delete_gcs_file(bucket_name, file_name)
+
+def discard_pending_cache(bucket_name: str, name: str) -> None:
+    """
+    drops the closed periods set aside by an earlier run that was never loaded;
+    they are fetched again, since they are not cached
+    """
+    for file_name in list_gcs_files(bucket_name, f"{PENDING_CACHE_PREFIX}/{name}/"):
+        delete_gcs_file(bucket_name, file_name)
+
+def flatten_report(report: Dict[str, Any], report_date: date) -> List[Dict[str, Any]]:
+    """
+    flattens the nested Rows/Cells of a Xero report into one record per row and value column
+
+    header rows name the value columns, sections name the rows nested in them,
+    and the first cell of each row is its label. the account ID is taken from
+    the 'account' attribute of the row's cells, where present
+
+    Args:
+        report (Dict[str, Any]): a single entry of the response's 'Reports' array
+        report_date (date): the date the report was requested for
+    """
+    records = []
+    columns: List[str] = []
+    position = itertools.count()
+
+    def walk(rows: List[Dict[str, Any]], section: Optional[str]) -> None:
+        for row in rows:
+            row_type = row.get('RowType')
+            cells = row.get('Cells', [])
+            if row_type == 'Header':
+                columns[:] = [cell.get('Value', '') for cell in cells]
+            elif row_type == 'Section':
+                walk(row.get('Rows', []), row.get('Title') or section)
+            elif cells:
+                row_index = next(position)
+                account_id = next(
+                    (
+                        attribute.get('Value')
+                        for cell in cells
+                        for attribute in cell.get('Attributes', [])
+                        if attribute.get('Id') == 'account'
+                    ),
+                    None,
+                )
+                for column_index, cell in enumerate(cells[1:], start=1):
+                    records.append({
+                        'report_id': report.get('ReportID'),
+                        'report_name': report.get('ReportName'),
+                        'report_date': report_date.isoformat(),
+                        'section': section,
+                        'row_type': row_type,
+                        'row_index': row_index,
+                        'label': cells[0].get('Value'),
+                        'account_id': account_id,
+                        'column': columns[column_index] if column_index < len(columns) else str(column_index),
+                        'value': cell.get('Value'),
+                    })
+
+    walk(report.get('Rows', []), None)
+    return records
+
+async def fetch_period(
+    name: str,
+    endpoint: str,
+    report_date: date,
+    closed: bool,
+    stats: Dict[str, int],
+) -> List[Dict[str, Any]]:
+    """
+    fetches and flattens the report for one date; a closed period is set aside
+    for the cache, see promote_report_cache()
+    """
+    client_id = CONFIG['CLIENT_ID']
+    bucket_name = CONFIG['BUCKET_NAME']
+
+    content = await asyncio.to_thread(fetch_report, endpoint, client_id, report_params(name, report_date))
+    stats['pages'] += 1
+    records = [
+        record
+        for report in json.loads(content).get('Reports', [])
+        for record in flatten_report(report, report_date)
+    ]
+    if closed:
+        cache_name = cache_file_name(name, report_date, PENDING_CACHE_PREFIX)
+        await asyncio.to_thread(write_json_to_gcs, bucket_name, cache_name, json.dumps(records))
+    return records
+
+async def process_report(name: str, endpoint: str) -> Optional[Dict[str, Any]]:
+    """
+    fetches a report for each date of the REPORT_PERIODS series concurrently,
+    up to REPORT_MAX_CONCURRENT_FETCHES at a time, flattens it to tabular
+    records and stores them as '<name>.json'
+
+    closed periods that are cached in the client bucket were loaded by an
+    earlier run, so they are neither fetched nor stored again: after the first
+    run, only the open periods cost API calls and reach BigQuery. periods that
+    fail are left out and the first of them is reported under 'failed_at'
+
+    Returns:
+        Optional[Dict[str, Any]]: run statistics of the report, or None if it failed
+    """
+    client_id = CONFIG['CLIENT_ID']
+    bucket_name = CONFIG['BUCKET_NAME']
+
+    try:
+        started = time.monotonic()
+        today = datetime.utcnow().date()
+        last_closed = closed_until(today)
+        await asyncio.to_thread(discard_pending_cache, bucket_name, name)
+        dates = await asyncio.to_thread(uncached_dates, bucket_name, name, today)
+        stats = {'pages': 0, 'records': 0, 'cached': CONFIG['REPORT_PERIODS'] - len(dates)}
+        # a backfill of every period at once would mostly collect 429s and tie up the default thread pool
+        limiter = asyncio.Semaphore(CONFIG['REPORT_MAX_CONCURRENT_FETCHES'])
+
+        async def fetch_limited(report_date: date) -> List[Dict[str, Any]]:
+            async with limiter:
+                return await fetch_period(name, endpoint, report_date, report_date <= last_closed, stats)
+
+        fetched = await asyncio.gather(
+            *[fetch_limited(report_date) for report_date in dates],
+            return_exceptions=True,
+        )
+        # keep the periods that were fetched even if others failed after their retries
+        failed = [report_date for report_date, period in zip(dates, fetched) if isinstance(period, Exception)]
+        if failed and len(failed) == len(dates):
+            raise fetched[0]
+        if failed:
+            stats['failed_at'] = failed[0].isoformat()
+            logger.warning(
+                f"salvaged {len(dates) - len(failed)} periods of report '{name}' for client '{client_id}'; "
+                f"failed: {', '.join(report_date.isoformat() for report_date in failed)}"
+            )
+        periods = [period for period in fetched if not isinstance(period, Exception)]
+
+        ingestion_time = datetime.utcnow().isoformat()
+        records = [{**record, "ingestion_time": ingestion_time} for period in periods for record in period]
+        stats['records'] = len(records)
+        content = encode_records(records).decode("UTF-8")
+        await asyncio.to_thread(write_json_to_gcs, bucket_name, f"{name}.json", content)
+        logger.info(
+            f"processed report '{name}' for client '{client_id}', periods fetched: {stats['pages']}, "
+            f"cached: {stats['cached']}, total records: {len(records)}"
+        )
+        return {
+            **stats,
+            'seconds': round(time.monotonic() - started, 1),
+            'completed_at': datetime.utcnow().isoformat(),
+        }
+    except Exception as e:
+        logger.error(f"error processing report '{name}' for client '{client_id}': {str(e)}")
+        return None
@@ -0,0 +1,190 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Callable, Dict, Iterator, Optional, TypeVar
+
+import requests
+
+from config import CONFIG
+from utils import get_logger
+
+logger = get_logger()
+
+T = TypeVar("T")
+
+class MalformedResponseError(Exception):
+    """
+    a response body that is cut off, e.g. by a dropped connection
+    """
+
+class CircuitOpenError(Exception):
+    """
+    a request refused without being sent, because the tenant's circuit breaker is open
+    """
+
+class RetryBudget:
+    """
+    the retries one run may spend across all of its requests, so a failing
+    upstream costs a bounded number of extra calls rather than a multiple of the run
+    """
+
+    def __init__(self, max_retries: int):
+        self.remaining = max_retries
+        self._lock = Lock()
+
+    def spend(self) -> bool:
+        """
+        takes one retry from the budget
+
+        Returns:
+            bool: False if the budget is exhausted
+        """
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class CircuitBreaker:
+    """
+    stops sending a tenant's requests after CIRCUIT_FAILURE_THRESHOLD consecutive
+    failures, for CIRCUIT_RESET_SECONDS
+
+    after that a single failure opens it again, until a request succeeds
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = Lock()
+
+    def check(self) -> None:
+        with self._lock:
+            remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"circuit open for another {remaining:.1f}s")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._open(self.reset_seconds)
+
+    def trip(self, seconds: float) -> None:
+        """
+        opens the circuit for at least `seconds`, e.g. when the tenant's daily quota is spent
+        """
+        with self._lock:
+            self._open(seconds)
+
+    def _open(self, seconds: float) -> None:
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+        self.failures = self.failure_threshold - 1
+
+# one breaker per tenant, shared by every run in the process
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = Lock()
+
+# the budget of the run the current task belongs to, see retry_budget_scope()
+_run_budget: ContextVar[Optional[RetryBudget]] = ContextVar("run_budget", default=None)
+
+def breaker_for(client_id: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if client_id not in _breakers:
+            _breakers[client_id] = CircuitBreaker(CONFIG['CIRCUIT_FAILURE_THRESHOLD'], CONFIG['CIRCUIT_RESET_SECONDS'])
+        return _breakers[client_id]
+
+@contextmanager
+def retry_budget_scope(max_retries: int) -> Iterator[RetryBudget]:
+    """
+    gives the requests of a run, including those made from its tasks and
+    to_thread workers, a shared retry budget
+    """
+    budget = RetryBudget(max_retries)
+    token = _run_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _run_budget.reset(token)
+
+def is_retryable(error: Exception) -> bool:
+    """
+    returns True for failures a later attempt may not hit: rate limiting,
+    server errors, timeouts, dropped connections and truncated bodies
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, MalformedResponseError)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    returns the wait in seconds the server asked for, if any
+    """
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After', '') if response is not None else ''
+    return float(value) if value.isdigit() else None
+
+def backoff_delay(attempt: int, requested: Optional[float] = None) -> float:
+    """
+    returns the wait before a retry: what the server asked for plus some jitter,
+    or a random wait of up to RETRY_BASE_SECONDS * 2^(attempt - 1), capped at
+    RETRY_MAX_SECONDS ("full jitter"), so concurrent retries spread out
+    """
+    if requested is not None:
+        return requested + random.uniform(0, CONFIG['RETRY_BASE_SECONDS'])
+    return random.uniform(0, min(CONFIG['RETRY_MAX_SECONDS'], CONFIG['RETRY_BASE_SECONDS'] * 2 ** (attempt - 1)))
+
+def call_with_retries(client_id: str, description: str, request: Callable[[], T]) -> T:
+    """
+    makes a request, retrying retryable failures with jittered exponential
+    backoff, up to RETRY_MAX_ATTEMPTS attempts and within the run's retry budget
+
+    fails fast without retrying on other errors, when the tenant's circuit
+    breaker is open, or when the server asks to wait longer than RETRY_MAX_SECONDS
+    (e.g. once the daily quota is spent), which also opens the breaker for that long
+
+    Args:
+        client_id (str): the tenant the request is for
+        description (str): what is being requested, for logging
+        request (Callable[[], T]): makes a single attempt
+    """
+    breaker = breaker_for(client_id)
+    budget = _run_budget.get()
+    attempt = 0
+    while True:
+        breaker.check()
+        attempt += 1
+        try:
+            result = request()
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            breaker.record_failure()
+            requested = retry_after(e)
+            if requested is not None and requested > CONFIG['RETRY_MAX_SECONDS']:
+                breaker.trip(requested)
+                raise
+            if attempt >= CONFIG['RETRY_MAX_ATTEMPTS']:
+                raise
+            if budget and not budget.spend():
+                logger.warning(f"retry budget of this run is spent; not retrying {description} for client {client_id}")
+                raise
+            delay = backoff_delay(attempt, requested)
+            logger.warning(
+                f"retrying {description} for client {client_id} in {delay:.1f}s "
+                f"(attempt {attempt + 1} of {CONFIG['RETRY_MAX_ATTEMPTS']}): {str(e)}"
+            )
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,181 @@
+import asyncio
+import hmac
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import Flask, abort, jsonify, request
+
+from authentication import preload_secrets
+from config import CONFIG, tenant_scope
+from main import ingest
+from utils import get_logger
+
+logger = get_logger()
+
+app = Flask(__name__)
+
+# Xero tenant IDs are UUIDs; they also name buckets and secrets, so nothing else is accepted
+TENANT_ID_PATTERN = re.compile(r"^[A-Za-z0-9-]+$")
+
+# statuses of finished syncs are kept for this many syncs
+SYNC_HISTORY = 1000
+
+# transform workers are forked, which is only safe before a process runs threads
+# or gRPC channels; the service always has both, so it transforms pages in threads
+if CONFIG['TRANSFORM_WORKERS'] > 0:
+    raise ValueError("TRANSFORM_WORKERS is not supported in service mode, set it to 0")
+
+class SyncService:
+    """
+    runs sync requests on one event loop in a background thread, so the HTTP
+    session, cloud clients and token cache stay warm from one sync to the next
+
+    syncs of different tenants run concurrently, up to SERVICE_MAX_CONCURRENT_SYNCS;
+    syncs of the same tenant queue behind each other, since they share its
+    bucket, change index and refresh token
+    """
+
+    def __init__(self, max_concurrent_syncs: int):
+        self.max_concurrent_syncs = max_concurrent_syncs
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="sync-loop", daemon=True)
+        self.thread.start()
+        self.syncs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # only touched on the loop's thread
+        self._tenant_locks: Dict[str, asyncio.Lock] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def submit(self, client_id: str, endpoints: Dict[str, str]) -> Tuple[str, Future]:
+        """
+        queues a sync of some endpoints of a tenant
+
+        Returns:
+            Tuple[str, Future]: the sync's ID and a future of its final status
+        """
+        sync_id = uuid.uuid4().hex
+        with self._lock:
+            self.syncs[sync_id] = {
+                'sync_id': sync_id,
+                'tenant': client_id,
+                'endpoints': list(endpoints),
+                'status': 'queued',
+                'submitted_at': datetime.utcnow().isoformat(),
+            }
+            while len(self.syncs) > SYNC_HISTORY:
+                self.syncs.popitem(last=False)
+        future = asyncio.run_coroutine_threadsafe(self.run_sync(sync_id, client_id, endpoints), self.loop)
+        return sync_id, future
+
+    def status(self, sync_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            sync = self.syncs.get(sync_id)
+            return dict(sync) if sync else None
+
+    def update(self, sync_id: str, **fields: Any) -> Dict[str, Any]:
+        with self._lock:
+            sync = self.syncs.setdefault(sync_id, {'sync_id': sync_id})
+            sync.update(fields)
+            return dict(sync)
+
+    async def run_sync(self, sync_id: str, client_id: str, endpoints: Dict[str, str]) -> Dict[str, Any]:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent_syncs)
+        tenant_lock = self._tenant_locks.setdefault(client_id, asyncio.Lock())
+
+        # wait for the tenant first, so a queued sync never holds a slot another tenant could use
+        async with tenant_lock, self._slots:
+            self.update(sync_id, status='running', started_at=datetime.utcnow().isoformat())
+            # each sync is a run of its own, never a task of a sharded job
+            with tenant_scope(client_id, SHARD_RUN_ID=None, SHARD_TASK_INDEX=0, SHARD_TASK_COUNT=1):
+                try:
+                    await asyncio.to_thread(preload_secrets, [client_id])
+                    result = await ingest(endpoints)
+                    status = 'failed' if result['failed'] else 'succeeded'
+                    return self.update(sync_id, status=status, finished_at=datetime.utcnow().isoformat(), **result)
+                except Exception as e:
+                    logger.error(f"sync {sync_id} of client {client_id} failed: {str(e)}")
+                    return self.update(
+                        sync_id, status='failed', finished_at=datetime.utcnow().isoformat(), error=str(e),
+                    )
+
+_service: Optional[SyncService] = None
+_service_lock = threading.Lock()
+
+def get_service() -> SyncService:
+    """
+    returns the sync service, starting it on first use; under gunicorn this
+    happens in the worker process, after forking
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = SyncService(CONFIG['SERVICE_MAX_CONCURRENT_SYNCS'])
+            logger.info(f"sync service started, running up to {CONFIG['SERVICE_MAX_CONCURRENT_SYNCS']} syncs at once")
+        return _service
+
+def resolve_endpoints(names: Optional[List[str]]) -> Dict[str, str]:
+    """
+    returns the configured endpoints with the given names, or all of them
+    """
+    if names is None:
+        return dict(CONFIG['ENDPOINTS'])
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        abort(400, description="endpoints must be a list of endpoint names")
+    unknown = [name for name in names if name not in CONFIG['ENDPOINTS']]
+    if unknown:
+        abort(400, description=f"unknown endpoints: {', '.join(unknown)}")
+    return {name: CONFIG['ENDPOINTS'][name] for name in names}
+
+@app.before_request
+def check_api_key():
+    if request.path == '/' or not CONFIG['SERVICE_API_KEY']:
+        return
+    # compared in constant time, so response times do not reveal how much of a guess matched
+    api_key = request.headers.get('X-API-KEY', '')
+    if not hmac.compare_digest(api_key.encode("UTF-8"), CONFIG['SERVICE_API_KEY'].encode("UTF-8")):
+        abort(401)
+
+@app.route('/', methods=['GET'])
+def home():
+    return "Data Fetching Service is running"
+
+@app.route('/sync', methods=['POST'])
+def sync():
+    """
+    starts a sync of a tenant: {"tenant": "<tenant ID>", "endpoints": ["invoices", ...], "wait": false}
+
+    the tenant defaults to CLIENT_ID and the endpoints to all configured ones.
+    returns 202 with the sync's ID, or its final status if "wait" is true
+    """
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        abort(400, description="the request body must be a JSON object")
+    client_id = body.get('tenant') or CONFIG['CLIENT_ID']
+    if not isinstance(client_id, str) or not TENANT_ID_PATTERN.match(client_id):
+        abort(400, description="invalid tenant ID")
+    endpoints = resolve_endpoints(body.get('endpoints'))
+
+    sync_id, future = get_service().submit(client_id, endpoints)
+    logger.info(f"queued sync {sync_id} of client {client_id}: {', '.join(endpoints)}")
+    if body.get('wait'):
+        result = future.result()
+        return jsonify(result), 200 if result['status'] == 'succeeded' else 500
+    return jsonify(get_service().status(sync_id)), 202
+
+@app.route('/syncs/<sync_id>', methods=['GET'])
+def sync_status(sync_id: str):
+    status = get_service().status(sync_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+if __name__ == '__main__':
+    # the service keeps its state in this process; under gunicorn use a single
+    # worker with several threads, e.g. `gunicorn -w 1 --threads 8 server:app`
+    app.run(host=CONFIG['SERVICE_HOST'], port=CONFIG['SERVICE_PORT'], threaded=True)
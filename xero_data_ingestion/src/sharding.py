@@ -0,0 +1,292 @@
+import asyncio
+import json
+import math
+from datetime import date, datetime
+from typing import Any, Dict, List
+
+from config import CONFIG, get_child_tables
+from data_pipeline import (
+    WorkUnit,
+    build_tombstones,
+    is_complete,
+    load_change_tracker,
+    output_file_name,
+    promote_pending_state,
+    run_work_units,
+    save_change_tracker,
+)
+from data_storage import write_json_to_gcs
+from date_windows import estimate_pages, window_label
+from manifest import ManifestStore, get_manifest_store
+from quota_planner import DEFAULT_PAGES, load_run_stats, plan_windows, save_run_stats, uses_date_windows
+from reports import is_report
+from table_loader import load_json_to_table
+from utils import get_logger
+
+logger = get_logger()
+
+# entries of the run manifest shared by all tasks
+PLAN_ENTRY = "plan.json"
+DONE_PREFIX = "done/"
+FINALIZE_CLAIM = "finalize.claim"
+FINALIZED = "finalized.json"
+MERGED_PREFIX = "merged/"
+LOADED_PREFIX = "loaded/"
+
+def done_entry(unit: WorkUnit) -> str:
+    return f"{DONE_PREFIX}{unit.key}.json"
+
+def split_endpoint_by_date(name: str, endpoint: str, history: Dict[str, Any], run_id: str) -> List[WorkUnit]:
+    """
+    splits an endpoint into date-window work units, sized from the page
+    counts its windows had in previous runs
+    """
+    windows = plan_windows(history)
+    return [
+        WorkUnit(
+            name, endpoint,
+            part=f"{run_id}/{window_label(window)}",
+            window_start=window[0].isoformat() if window[0] else None,
+            window_end=window[1].isoformat() if window[1] else None,
+        )
+        for window in windows
+    ]
+
+def split_endpoint(name: str, endpoint: str, history: Dict[str, Any], run_id: str) -> List[WorkUnit]:
+    """
+    splits an endpoint into date windows if it supports them, otherwise into
+    page-range work units of SHARD_PAGES_PER_UNIT pages
+
+    the last page range is open-ended so pages added since the last run are not missed
+    """
+    if is_report(name):
+        # a report's periods are fetched concurrently within a single unit
+        return [WorkUnit(name, endpoint)]
+    if uses_date_windows(name):
+        return split_endpoint_by_date(name, endpoint, history, run_id)
+
+    estimated_pages = history.get('pages', DEFAULT_PAGES)
+    pages_per_unit = CONFIG['SHARD_PAGES_PER_UNIT']
+    if estimated_pages <= pages_per_unit:
+        return [WorkUnit(name, endpoint)]
+
+    units = [
+        WorkUnit(name, endpoint, start, start + pages_per_unit - 1, f"{run_id}/pages-{start:05d}")
+        for start in range(1, estimated_pages + 1, pages_per_unit)
+    ]
+    units[-1] = units[-1]._replace(end_page=None)
+    return units
+
+def estimate_unit_pages(unit: WorkUnit, history: Dict[str, Any]) -> int:
+    if unit.window_start or unit.window_end:
+        window = tuple(date.fromisoformat(day) if day else None for day in (unit.window_start, unit.window_end))
+        return math.ceil(estimate_pages(window, history.get('windows', [])) or DEFAULT_PAGES)
+    if unit.end_page is not None:
+        return unit.end_page - unit.start_page + 1
+    return max(history.get('pages', DEFAULT_PAGES) - unit.start_page + 1, 1)
+
+def assign_units(units: List[WorkUnit], weights: Dict[str, int], task_count: int) -> Dict[str, int]:
+    """
+    assigns work units to tasks, heaviest first, each to the least loaded task
+
+    ties are broken by unit key and task index, so the assignment only depends
+    on its inputs
+    """
+    loads = [0] * task_count
+    assignments = {}
+    for unit in sorted(units, key=lambda unit: (-weights[unit.key], unit.key)):
+        task_index = min(range(task_count), key=lambda index: (loads[index], index))
+        assignments[unit.key] = task_index
+        loads[task_index] += weights[unit.key]
+    return assignments
+
+def build_shard_plan(endpoints: Dict[str, str], run_id: str, task_count: int) -> Dict[str, Any]:
+    """
+    splits the endpoints into work units from their page counts in previous
+    runs and assigns the units to tasks
+    """
+    history = load_run_stats(CONFIG['BUCKET_NAME'])
+    units, weights = [], {}
+    for name, endpoint in endpoints.items():
+        for unit in split_endpoint(name, endpoint, history.get(name, {}), run_id):
+            units.append(unit)
+            weights[unit.key] = estimate_unit_pages(unit, history.get(name, {}))
+
+    assignments = assign_units(units, weights, task_count)
+    return {
+        'run_id': run_id,
+        'task_count': task_count,
+        'units': [{**unit._asdict(), 'task_index': assignments[unit.key]} for unit in units],
+    }
+
+def load_or_create_plan(store: ManifestStore, endpoints: Dict[str, str], run_id: str, task_count: int) -> Dict[str, Any]:
+    """
+    returns the run's shard plan, creating it if this task is the first to get here
+
+    tasks may start at different times (e.g. when parallelism is below the task
+    count) and see different run history, so the first plan written wins and
+    every task follows it
+    """
+    plan = build_shard_plan(endpoints, run_id, task_count)
+    if store.create(PLAN_ENTRY, json.dumps(plan)):
+        logger.info(f"created shard plan for run {run_id}: {len(plan['units'])} work units over {task_count} tasks")
+        return plan
+    return json.loads(store.read(PLAN_ENTRY))
+
+def plan_units(plan: Dict[str, Any]) -> List[WorkUnit]:
+    return [WorkUnit(**{field: unit[field] for field in WorkUnit._fields}) for unit in plan['units']]
+
+def aggregate_run_stats(units: List[WorkUnit], results: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    combines the statistics of the units of each endpoint into per-endpoint statistics
+    """
+    run_stats = {}
+    for unit in units:
+        result = results[unit.key]
+        stats = run_stats.setdefault(unit.name, {'pages': 0, 'records': 0, 'seconds': 0, 'completed_at': ''})
+        stats['pages'] += result['pages']
+        stats['records'] += result['records']
+        # units of an endpoint run in parallel, so its duration is that of its slowest unit
+        stats['seconds'] = max(stats['seconds'], result['seconds'])
+        stats['completed_at'] = max(stats['completed_at'], result['completed_at'])
+        if unit.window_start or unit.window_end:
+            # lets the next run size its windows by observed density
+            stats.setdefault('windows', []).append([unit.window_start, unit.window_end, result['pages']])
+    return run_stats
+
+def finalize_run(store: ManifestStore, plan: Dict[str, Any]) -> None:
+    """
+    completes a sharded run once every work unit is done: derives deletions of
+    split endpoints from the merged hash indexes of their units, records run
+    statistics and loads all outputs into BigQuery
+
+    a retried finalization skips the endpoints whose indexes it already merged,
+    since merging again would find no deletions and overwrite their tombstones,
+    and those it already loaded, since loading appends
+
+    Raises:
+        RuntimeError: if a table failed to load; the endpoint keeps its previous
+        hash index and is loaded by the retry
+    """
+    bucket_name = CONFIG['BUCKET_NAME']
+    run_id = plan['run_id']
+    units = plan_units(plan)
+    results = {unit.key: json.loads(store.read(done_entry(unit))) for unit in units}
+    endpoints = {unit.name: unit.endpoint for unit in units}
+    split_names = sorted({unit.name for unit in units if unit.part})
+
+    ingestion_time = datetime.utcnow().isoformat()
+    merged = set(store.list(MERGED_PREFIX))
+    for name in split_names:
+        if f"{MERGED_PREFIX}{name}.json" in merged:
+            continue
+        tracker = load_change_tracker(bucket_name, name)
+        if not tracker:
+            continue
+        for unit in units:
+            if unit.name == name:
+                tracker.index.update(results[unit.key].get('cdc_index', {}))
+        tombstones = build_tombstones(tracker, name, ingestion_time)
+        for output_name in [name, *get_child_tables(name)]:
+            content = tombstones.get(output_name, b"").decode("UTF-8")
+            write_json_to_gcs(bucket_name, output_file_name(output_name, f"{run_id}/tombstones"), content)
+        save_change_tracker(bucket_name, name, tracker)
+        store.create(f"{MERGED_PREFIX}{name}.json", json.dumps(tracker.counts))
+        logger.info(f"merged change index for split endpoint '{name}': {tracker.counts['delete']} deletions")
+
+    save_run_stats(bucket_name, aggregate_run_stats(units, results))
+
+    # split endpoints are loaded from all of their parts at once
+    sources = {
+        output_name: f"gs://{bucket_name}/{output_name}/{run_id}/*.json"
+        for name in split_names
+        for output_name in [name, *get_child_tables(name)]
+    }
+    loaded = set(store.list(LOADED_PREFIX))
+    unloaded = {name: endpoint for name, endpoint in endpoints.items() if f"{LOADED_PREFIX}{name}.json" not in loaded}
+    failed_tables = load_json_to_table(unloaded, sources)
+    for name in promote_pending_state(bucket_name, list(unloaded), failed_tables):
+        store.create(f"{LOADED_PREFIX}{name}.json", json.dumps({'loaded_at': datetime.utcnow().isoformat()}))
+    if failed_tables:
+        raise RuntimeError(f"tables failed to load: {', '.join(failed_tables)}")
+
+def work_unit_endpoints(endpoints: Dict[str, str]) -> Dict[str, str]:
+    """
+    returns the endpoints a run has to split into work units: all of them if
+    the run is spread over several tasks, otherwise those fetched in date windows
+
+    a lone task outside Cloud Run cannot resume its run, so it keeps the other
+    endpoints out of the run manifest: a failed window would otherwise hold
+    back their load until a run that never comes
+    """
+    if CONFIG['SHARD_TASK_COUNT'] > 1:
+        return dict(endpoints)
+    return {name: endpoint for name, endpoint in endpoints.items() if uses_date_windows(name)}
+
+async def run_sharded(endpoints: Dict[str, str]) -> bool:
+    """
+    runs this task's share of a run split into work units, possibly across
+    Cloud Run job tasks
+
+    units already marked done in the run manifest (e.g. by a previous attempt
+    of this task) are skipped. the task that completes the last unit finalizes
+    the run, including the BigQuery load
+
+    Args:
+        endpoints (Dict[str, str]): endpoint name -> URL to run
+
+    Returns:
+        bool: True if this task finalized the run
+    """
+    task_index = CONFIG['SHARD_TASK_INDEX']
+    task_count = CONFIG['SHARD_TASK_COUNT']
+    run_id = CONFIG['SHARD_RUN_ID']
+    if not run_id:
+        if task_count > 1:
+            raise ValueError("a sharded run needs SHARD_RUN_ID or CLOUD_RUN_EXECUTION to identify it")
+        # a lone task can name its own run, it just cannot be resumed
+        run_id = datetime.utcnow().strftime("run-%Y%m%dT%H%M%S")
+    store = get_manifest_store(CONFIG['BUCKET_NAME'], run_id, CONFIG['SHARD_MANIFEST_DIR'])
+
+    plan = await asyncio.to_thread(load_or_create_plan, store, endpoints, run_id, task_count)
+    units = plan_units(plan)
+    assigned = [unit for unit, entry in zip(units, plan['units']) if entry['task_index'] == task_index]
+    done = set(await asyncio.to_thread(store.list, DONE_PREFIX))
+    pending = [unit for unit in assigned if done_entry(unit) not in done]
+    logger.info(
+        f"task {task_index}/{task_count} of run {run_id}: {len(pending)} work units to run, "
+        f"{len(assigned) - len(pending)} already done"
+    )
+
+    # salvaged units leave their indexes alone: they are refetched whole before the run is loaded
+    results = await run_work_units(pending, save_salvaged_index=False)
+    for unit, result in zip(pending, results):
+        if is_complete(result):
+            await asyncio.to_thread(store.create, done_entry(unit), json.dumps(result))
+
+    # a salvaged unit is not done: its retry refetches it and overwrites its part
+    failed = [unit.key for unit, result in zip(pending, results) if not is_complete(result)]
+    if failed:
+        # fail the task so Cloud Run retries it; the retry only reruns the failed units
+        raise RuntimeError(f"work units failed: {', '.join(failed)}")
+
+    done = set(await asyncio.to_thread(store.list, DONE_PREFIX))
+    remaining = [unit.key for unit in units if done_entry(unit) not in done]
+    if remaining:
+        logger.info(f"task {task_index} finished; waiting on {len(remaining)} work units in other tasks")
+        return False
+
+    if await asyncio.to_thread(store.read, FINALIZED) is not None:
+        logger.info(f"run {run_id} is already finalized")
+        return False
+    if not await asyncio.to_thread(store.create, FINALIZE_CLAIM, json.dumps({'task_index': task_index})):
+        # the claim stays with its task, so only a retry of that task finishes a failed finalization
+        claim = json.loads(await asyncio.to_thread(store.read, FINALIZE_CLAIM))
+        if claim['task_index'] != task_index:
+            return False
+        logger.warning(f"task {task_index} claimed run {run_id} without finalizing it; finalizing again")
+    else:
+        logger.info(f"task {task_index} completed the last work unit of run {run_id}; finalizing")
+    await asyncio.to_thread(finalize_run, store, plan)
+    await asyncio.to_thread(store.create, FINALIZED, json.dumps({'task_index': task_index}))
+    return True
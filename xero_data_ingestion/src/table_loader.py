@@ -3,9 +3,10 @@ from google.cloud import storage
 import json
 import io
 import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-from config import CONFIG
+from config import CONFIG, get_child_tables
+from profiling import timed
 from utils import get_logger
 
 logger = get_logger()
@@ -14,11 +15,24 @@ logger = get_logger()
 bigquery_client = bigquery.Client(project=CONFIG['PROJECT_ID'])
 storage_client = storage.Client()
 
-def load_json_to_table() -> None:
+def load_json_to_table(
+    endpoints: Optional[Dict[str, str]] = None,
+    sources: Optional[Dict[str, str]] = None,
+) -> List[str]:
     """
     loads JSON data from GCS into BigQuery tables for each endpoint
+
+    Args:
+        endpoints (Optional[Dict[str, str]]): endpoint name -> URL to load, defaults
+            to every configured endpoint
+        sources (Optional[Dict[str, str]]): table name -> GCS URI (wildcards allowed)
+            for tables not loaded from the default 'gs://<bucket>/<table>.json'
+
+    Returns:
+        List[str]: the names of the tables that could not be created or loaded
     """
-    endpoints = CONFIG['ENDPOINTS']
+    sources = sources or {}
+    endpoints = endpoints if endpoints is not None else CONFIG['ENDPOINTS']
     project_id = CONFIG['PROJECT_ID']
     client_id = CONFIG['CLIENT_ID']
     bucket_name = CONFIG['BUCKET_NAME']
@@ -40,15 +54,26 @@ def load_json_to_table() -> None:
         logger.error(f"error accessing dataset {dataset_id}: {str(e)}")
         raise
 
-    for endpoint in endpoints.keys():
-        table_id = f"{dataset_id}.xero_{endpoint}"
+    # each endpoint plus the child tables its nested arrays are normalized into
+    table_names = [
+        table_name
+        for endpoint in endpoints.keys()
+        for table_name in [endpoint, *get_child_tables(endpoint)]
+    ]
+
+    failed_tables = []
+    for table_name in table_names:
+        table_id = f"{dataset_id}.xero_{table_name}"
 
         # define table schema
         schema = [
-            bigquery.SchemaField("ingestion_time", "TIMESTAMP", mode="REQUIRED")
+            bigquery.SchemaField("ingestion_time", "TIMESTAMP", mode="REQUIRED"),
+            # only populated when change detection is enabled; kept either way, since a
+            # load schema lacking a column the table already has would be rejected
+            bigquery.SchemaField("cdc_operation", "STRING", mode="NULLABLE")
         ]
 
-        table_ref = bigquery_client.dataset(dataset_id).table(f"xero_{endpoint}")
+        table_ref = bigquery_client.dataset(dataset_id).table(f"xero_{table_name}")
 
         # create or ensure table exists
         try:
@@ -57,22 +82,30 @@ def load_json_to_table() -> None:
             logger.info(f"ensured table {table_id} exists.")
         except Exception as e:
             logger.error(f"error creating table {table_id}: {str(e)}")
+            failed_tables.append(table_name)
             continue
 
         # Load data from GCS to BigQuery
         try:
-            uri = f"gs://{bucket_name}/{endpoint}.json"
+            uri = sources.get(table_name, f"gs://{bucket_name}/{table_name}.json")
             job_config = bigquery.LoadJobConfig(
                 schema=schema,
                 source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-                write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+                write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+                # create_table(exists_ok=True) leaves existing tables as they are, so
+                # fields added since they were created (e.g. cdc_operation) are added here
+                schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
             )
-            load_job = bigquery_client.load_table_from_uri(
-                uri,
-                table_ref,
-                job_config=job_config
-            )
-            load_job.result()  # Wait for the job to complete
+            with timed('load', table_name):
+                load_job = bigquery_client.load_table_from_uri(
+                    uri,
+                    table_ref,
+                    job_config=job_config
+                )
+                load_job.result()  # Wait for the job to complete
             logger.info(f"loaded data into {table_id} from {uri}")
         except Exception as e:
-            logger.error(f"error loading data into {table_id} from {uri}: {str(e)}")
\ No newline at end of file
+            logger.error(f"error loading data into {table_id} from {uri}: {str(e)}")
+            failed_tables.append(table_name)
+
+    return failed_tables
\ No newline at end of file
@@ -0,0 +1,135 @@
+import json
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from change_capture import CDC_OPERATION_FIELD, record_hash
+from profiling import timed
+
+# this module runs inside transform worker processes, so it must stay free of
+# cloud clients and anything else that is expensive to import or unsafe to fork
+
+# position of a child row within its parent's nested array
+LINE_INDEX_FIELD = "line_index"
+
+def encode_records(records: List[Dict[str, Any]]) -> bytes:
+    """
+    encodes records as newline-delimited JSON
+    """
+    return b"".join(json.dumps(record).encode("UTF-8") + b"\n" for record in records)
+
+def split_record(
+    item: Dict[str, Any],
+    ingestion_time: str,
+    parent_id_field: Optional[str],
+    children: Dict[str, str],
+) -> Tuple[Dict[str, Any], Dict[str, List[Dict[str, Any]]]]:
+    """
+    stamps a record with the ingestion time and explodes its configured nested
+    arrays into child rows keyed by the parent's ID
+
+    Args:
+        item (Dict[str, Any]): the record as returned by the API
+        ingestion_time (str): the ingestion timestamp of this run
+        parent_id_field (Optional[str]): the record's ID field, copied onto each child row
+        children (Dict[str, str]): child output name -> nested array field, e.g.
+            {'invoices__line_items': 'LineItems'}
+
+    Returns:
+        Tuple[Dict[str, Any], Dict[str, List[Dict[str, Any]]]]: the parent row without
+        the exploded arrays, and the child rows per child output
+    """
+    if not children:
+        return {**item, "ingestion_time": ingestion_time}, {}
+
+    nested_fields = set(children.values())
+    parent = {key: value for key, value in item.items() if key not in nested_fields}
+    parent["ingestion_time"] = ingestion_time
+    parent_id = item.get(parent_id_field)
+
+    child_rows = {}
+    for output_name, field in children.items():
+        child_rows[output_name] = [
+            {
+                parent_id_field: parent_id,
+                LINE_INDEX_FIELD: line_index,
+                **(child if isinstance(child, dict) else {"value": child}),
+                "ingestion_time": ingestion_time,
+            }
+            for line_index, child in enumerate(item.get(field) or [])
+        ]
+    return parent, child_rows
+
+def encode_page(
+    content: bytes,
+    items_key: str,
+    ingestion_time: str,
+    output_name: str,
+    parent_id_field: Optional[str] = None,
+    children: Optional[Dict[str, str]] = None,
+) -> Tuple[Dict[str, bytes], int]:
+    """
+    decodes a raw response page, stamps and normalizes its records and encodes
+    them as NDJSON
+
+    Returns:
+        Tuple[Dict[str, bytes], int]: the encoded chunk per output and the number
+        of records on the page
+    """
+    children = children or {}
+    with timed('decode'):
+        items = json.loads(content).get(items_key, [])
+    with timed('serialize'):
+        parents = []
+        child_rows = {child_name: [] for child_name in children}
+        for item in items:
+            parent, rows = split_record(item, ingestion_time, parent_id_field, children)
+            parents.append(parent)
+            for child_name, child_records in rows.items():
+                child_rows[child_name].extend(child_records)
+
+        outputs = {output_name: encode_records(parents)}
+        for child_name, child_records in child_rows.items():
+            outputs[child_name] = encode_records(child_records)
+    return outputs, len(items)
+
+def hash_and_encode_page(
+    content: bytes,
+    items_key: str,
+    ingestion_time: str,
+    id_field: str,
+    volatile_fields: FrozenSet[str],
+    children: Optional[Dict[str, str]] = None,
+) -> List[Tuple[Optional[str], str, bytes, Dict[str, List[bytes]]]]:
+    """
+    decodes a raw response page and returns, for each record, its ID, its
+    change-detection digest, its stamped NDJSON line and the NDJSON lines of its
+    child rows (lines without a trailing newline)
+
+    the digest covers the nested arrays too, so a changed line item marks its
+    parent as updated
+    """
+    children = children or {}
+    with timed('decode'):
+        items = json.loads(content).get(items_key, [])
+    with timed('serialize'):
+        hashed = []
+        for item in items:
+            parent, rows = split_record(item, ingestion_time, id_field, children)
+            hashed.append((
+                item.get(id_field),
+                record_hash(item, volatile_fields),
+                json.dumps(parent).encode("UTF-8"),
+                {
+                    child_name: [json.dumps(row).encode("UTF-8") for row in child_records]
+                    for child_name, child_records in rows.items()
+                },
+            ))
+    return hashed
+
+def tag_line(line: bytes, operation: str) -> bytes:
+    """
+    appends the change operation to an encoded record without decoding it again
+
+    relies on lines being JSON objects produced by json.dumps, which always end
+    with a closing brace and always carry at least the ingestion time
+    """
+    return line[:-1] + f', "{CDC_OPERATION_FIELD}": "{operation}"}}'.encode("UTF-8")
@@ -0,0 +1,110 @@
+import os
+import sys
+import tempfile
+
+import google.auth
+import pytest
+from cryptography.fernet import Fernet
+from google.auth.credentials import AnonymousCredentials
+
+# the modules under src/ import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# the config module reads its settings on import, so the test environment is
+# set up before any test module imports it: storage goes to a local directory,
+# tokens to a local encrypted file, and no call leaves the machine
+_scratch = tempfile.mkdtemp(prefix="xero-tests-")
+os.environ.update({
+    "CLIENT_ID": "test-tenant",
+    "PROJECT_ID": "test-project",
+    "PROJECT_NUMBER": "123456789",
+    "LOCAL_STORAGE_DIR": os.path.join(_scratch, "storage"),
+    "TOKEN_STORE": "local",
+    "TOKEN_STORE_PATH": os.path.join(_scratch, "tokens.enc"),
+    "TOKEN_STORE_KEY": Fernet.generate_key().decode(),
+})
+
+# cloud clients created on import (e.g. BigQuery's) look for credentials, never use them here
+google.auth.default = lambda *args, **kwargs: (AnonymousCredentials(), os.environ["PROJECT_ID"])
+
+@pytest.fixture(autouse=True)
+def local_storage(tmp_path, monkeypatch):
+    """
+    gives every test an empty bucket directory
+    """
+    from config import CONFIG
+    monkeypatch.setitem(CONFIG, "LOCAL_STORAGE_DIR", str(tmp_path / "storage"))
+    return tmp_path / "storage"
+
+class FakeXero:
+    """
+    serves the pages of paginated endpoints from records held in memory, in
+    place of api_client.fetch_page
+
+    Attributes:
+        records (Dict[str, List[Dict]]): records per items key, e.g. 'Invoices'
+        failing_pages (Set[int]): pages that fail as if they ran out of retries
+        failing_keys (Set[str]): items keys all of whose pages fail
+        calls (List[Tuple[str, int]]): (items key, page) of every request made
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.failing_pages = set()
+        self.failing_keys = set()
+        self.calls = []
+
+    def fetch_page(self, endpoint, client_id, page, page_size=100, where=None):
+        import json
+        from api_client import items_key_for
+
+        items_key = items_key_for(endpoint)
+        self.calls.append((items_key, page))
+        if page in self.failing_pages or items_key in self.failing_keys:
+            raise ConnectionError(f"page {page} failed")
+        records = self.records.get(items_key, [])
+        page_count = max(-(-len(records) // page_size), 1)
+        items = records[(page - 1) * page_size:page * page_size]
+        return json.dumps({"pagination": {"page": page, "pageCount": page_count}, items_key: items}).encode("UTF-8")
+
+@pytest.fixture
+def xero(monkeypatch):
+    """
+    replaces the Xero API with a FakeXero
+    """
+    import api_client
+    fake = FakeXero()
+    monkeypatch.setattr(api_client, "fetch_page", fake.fetch_page)
+    return fake
+
+class FakeBigQuery:
+    """
+    records loads in place of table_loader.load_json_to_table
+
+    Attributes:
+        loads (List[List[str]]): the endpoints of every load, sorted
+        failing_tables (Set[str]): tables whose load fails
+    """
+
+    def __init__(self):
+        self.loads = []
+        self.failing_tables = set()
+
+    def load_json_to_table(self, endpoints=None, sources=None):
+        from config import get_child_tables
+
+        self.loads.append(sorted(endpoints))
+        tables = [table for name in endpoints for table in [name, *get_child_tables(name)]]
+        return [table for table in tables if table in self.failing_tables]
+
+@pytest.fixture
+def bigquery(monkeypatch):
+    """
+    replaces the BigQuery loads of the pipeline with a FakeBigQuery
+    """
+    import main
+    import sharding
+    fake = FakeBigQuery()
+    monkeypatch.setattr(main, "load_json_to_table", fake.load_json_to_table)
+    monkeypatch.setattr(sharding, "load_json_to_table", fake.load_json_to_table)
+    return fake
@@ -0,0 +1,123 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from cryptography.fernet import Fernet
+
+import authentication
+from authentication import (
+    LocalTokenStore, SecretManagerTokenStore, get_token, store_tokens, token_secret_id,
+)
+
+SECRET = token_secret_id("tenant")
+
+class FakeSecretManager:
+    """
+    keeps the enabled versions of secrets in memory, in place of the Secret
+    Manager client
+
+    Attributes:
+        versions (List[SimpleNamespace]): enabled versions, with a name and create_time
+        requests (List[Dict]): requests of every list_secret_versions call
+        destroyed (List[str]): names of the destroyed versions, in order
+        failing_list (bool): list_secret_versions fails
+    """
+
+    def __init__(self):
+        self.versions = []
+        self.requests = []
+        self.destroyed = []
+        self.failing_list = False
+
+    def add_secret_version(self, parent, payload):
+        number = len(self.versions) + len(self.destroyed) + 1
+        self.versions.append(SimpleNamespace(name=f"{parent}/versions/{number}", create_time=number))
+
+    def list_secret_versions(self, request):
+        self.requests.append(request)
+        if self.failing_list:
+            raise RuntimeError("list failed")
+        # oldest first, so only sorting by create_time keeps the newest
+        return list(self.versions)
+
+    def destroy_secret_version(self, name):
+        self.destroyed.append(name)
+        self.versions = [version for version in self.versions if version.name != name]
+
+def tokens(expires_at, refresh_token="refresh"):
+    return {
+        "access_token": "access", "refresh_token": refresh_token, "expires_in": 1800,
+        "token_type": "Bearer", "scope": "offline_access", "expires_at": expires_at,
+    }
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key().decode()
+
+@pytest.fixture
+def local_store(tmp_path, key, monkeypatch):
+    store = LocalTokenStore(str(tmp_path / "tokens.enc"), key)
+    monkeypatch.setattr(authentication, "token_store", store)
+    monkeypatch.setattr(authentication, "_token_cache", {})
+    return store
+
+def test_local_store_round_trip(local_store, key):
+    local_store.write(SECRET, "value")
+    local_store.write("other", "other value")
+    with open(local_store.path, "rb") as store:
+        assert b"value" not in store.read()
+
+    # a second process sharing the file and key
+    other = LocalTokenStore(local_store.path, key)
+    assert other.fetch(SECRET) == "value"
+    other.preload([SECRET, "other", "missing"])
+    assert set(other._values) == {SECRET, "other"}
+
+    local_store.save(SECRET, "new value")
+    # read from the cache until it is older than max_age
+    assert other.read(SECRET) == "value"
+    assert other.read(SECRET, max_age=0) == "new value"
+
+def test_prune_destroys_enabled_versions_beyond_those_kept():
+    store = SecretManagerTokenStore("projects/123", versions_to_keep=2)
+    store._client = client = FakeSecretManager()
+    for index in range(4):
+        store.save(SECRET, f"value {index}")
+
+    parent = f"projects/123/secrets/{SECRET}"
+    assert client.requests[-1] == {"parent": parent, "filter": "state:ENABLED"}
+    assert client.destroyed == [f"{parent}/versions/1", f"{parent}/versions/2"]
+    assert [version.name for version in client.versions] == [f"{parent}/versions/3", f"{parent}/versions/4"]
+
+def test_pruning_failure_does_not_fail_storing_tokens(monkeypatch):
+    store = SecretManagerTokenStore("projects/123", versions_to_keep=2)
+    store._client = client = FakeSecretManager()
+    client.failing_list = True
+    monkeypatch.setattr(authentication, "token_store", store)
+
+    store_tokens("tenant", tokens(0))
+    assert len(client.versions) == 1
+    assert store.read(SECRET) == json.dumps(tokens(0))
+
+def test_expired_tokens_are_read_again_before_refreshing(local_store, monkeypatch):
+    refreshed = []
+    monkeypatch.setattr(authentication, "refresh_access_token", lambda client_id, refresh_token: refreshed.append(refresh_token))
+    # this process read the tokens a while ago, another one has refreshed them since
+    local_store._values[SECRET] = (json.dumps(tokens(0)), time.time() - 2 * authentication.TOKEN_REREAD_SECONDS)
+    fresh = tokens(time.time() + 1800, refresh_token="rotated")
+    local_store.save(SECRET, json.dumps(fresh))
+
+    assert get_token("tenant") == fresh
+    assert refreshed == []
+
+def test_tokens_still_expired_when_read_again_are_refreshed(local_store, monkeypatch):
+    monkeypatch.setattr(
+        authentication, "refresh_access_token",
+        lambda client_id, refresh_token: tokens(time.time() + 1800, refresh_token=f"after {refresh_token}"),
+    )
+    local_store._values[SECRET] = (json.dumps(tokens(0)), time.time() - 2 * authentication.TOKEN_REREAD_SECONDS)
+    local_store.save(SECRET, json.dumps(tokens(0, refresh_token="rotated")))
+
+    # the refresh uses the refresh token just read, not the rotated-away one
+    assert get_token("tenant")["refresh_token"] == "after rotated"
@@ -0,0 +1,38 @@
+from change_capture import ChangeTracker, parse_index, record_hash, serialize_index
+
+def test_record_hash_ignores_key_order_and_volatile_fields():
+    volatile = frozenset({"UpdatedDateUTC"})
+    first = record_hash({"InvoiceID": "1", "Total": 10, "UpdatedDateUTC": "a"}, volatile)
+    second = record_hash({"Total": 10, "UpdatedDateUTC": "b", "InvoiceID": "1"}, volatile)
+    assert first == second
+    assert first != record_hash({"InvoiceID": "1", "Total": 11}, volatile)
+
+def test_classify_against_previous_index():
+    tracker = ChangeTracker("InvoiceID", {"1": "aaa", "2": "bbb"})
+    assert tracker.classify("1", "aaa") is None
+    assert tracker.classify("2", "changed") == "update"
+    assert tracker.classify("3", "ccc") == "insert"
+    assert tracker.classify(None, "ddd") == "insert"
+    assert tracker.index == {"1": "aaa", "2": "changed", "3": "ccc"}
+    assert tracker.counts == {"insert": 2, "update": 1, "delete": 0, "unchanged": 1}
+
+def test_tombstones_for_records_not_seen():
+    tracker = ChangeTracker("InvoiceID", {"1": "aaa", "2": "bbb", "3": "ccc"})
+    tracker.classify("2", "bbb")
+    assert tracker.tombstones() == [
+        {"InvoiceID": "1", "cdc_operation": "delete"},
+        {"InvoiceID": "3", "cdc_operation": "delete"},
+    ]
+    assert tracker.counts["delete"] == 2
+
+def test_carry_over_unseen_keeps_previous_digests():
+    tracker = ChangeTracker("InvoiceID", {"1": "aaa", "2": "bbb", "3": "ccc"})
+    tracker.classify("1", "changed")
+    tracker.carry_over_unseen()
+    assert tracker.index == {"1": "changed", "2": "bbb", "3": "ccc"}
+    assert tracker.tombstones() == []
+
+def test_index_round_trip():
+    content = serialize_index("InvoiceID", {"2": "bbb", "1": "aaa"})
+    assert list(parse_index(content)) == ["1", "2"]
+    assert parse_index(None) == {}
@@ -0,0 +1,138 @@
+import asyncio
+import json
+
+import pytest
+
+import data_pipeline
+from config import CONFIG
+from data_pipeline import WorkUnit, run_pipeline, run_work_units
+from data_storage import read_json_from_gcs
+from main import ingest
+
+INVOICES = "https://api.xero.com/api.xro/2.0/Invoices"
+
+def invoices(count, version=0):
+    return [{"InvoiceID": str(index), "Total": index + version} for index in range(1, count + 1)]
+
+def read_records(name):
+    content = read_json_from_gcs(CONFIG['BUCKET_NAME'], name) or ""
+    return [json.loads(line) for line in content.splitlines()]
+
+def read_index(name="invoices"):
+    return json.loads(read_json_from_gcs(CONFIG['BUCKET_NAME'], f"_cdc/{name}.index.json"))["hashes"]
+
+@pytest.fixture
+def cdc(monkeypatch):
+    monkeypatch.setitem(CONFIG, "CDC_ENABLED", True)
+    monkeypatch.setitem(CONFIG, "PAGE_SIZE", 2)
+
+@pytest.mark.parametrize("endpoint_count,budget_pages", [(1, 3), (4, 6)])
+def test_small_byte_budget_does_not_deadlock(xero, monkeypatch, endpoint_count, budget_pages):
+    record = {"InvoiceID": "x" * 36, "Reference": "y" * 200}
+    names = ["Invoices", "CreditNotes", "Payments", "Overpayments"][:endpoint_count]
+    for name in names:
+        xero.records[name] = [record] * 400
+    # a budget of exactly so many pages, which their queues fill; encoded chunks are larger than raw pages
+    page_bytes = len(xero.fetch_page(INVOICES, CONFIG['CLIENT_ID'], 1, 10))
+    monkeypatch.setitem(CONFIG, "PAGE_SIZE", 10)
+    monkeypatch.setitem(CONFIG, "PIPELINE_MAX_INFLIGHT_PAGES", 8)
+    monkeypatch.setitem(CONFIG, "PIPELINE_MAX_CONCURRENT_ENDPOINTS", 4)
+    monkeypatch.setitem(CONFIG, "PIPELINE_MAX_INFLIGHT_BYTES", budget_pages * page_bytes)
+
+    # transforms lagging behind fetching fill the page queues
+    transform_page = data_pipeline.transform_page
+    async def slow_transform_page(*args):
+        await asyncio.sleep(0.002)
+        return await transform_page(*args)
+    monkeypatch.setattr(data_pipeline, "transform_page", slow_transform_page)
+
+    endpoints = {name.lower(): f"https://api.xero.com/api.xro/2.0/{name}" for name in names}
+    results = asyncio.run(asyncio.wait_for(run_pipeline(endpoints), 10))
+    assert {name: stats['records'] for name, stats in results.items()} == {name: 400 for name in endpoints}
+
+def test_salvaged_endpoint_keeps_fetched_pages_and_unseen_digests(xero, bigquery, cdc):
+    xero.records["Invoices"] = invoices(6)
+    asyncio.run(ingest({"invoices": INVOICES}))
+    first_index = read_index()
+
+    xero.records["Invoices"] = invoices(6, version=1)
+    xero.failing_pages = {3}
+    result = asyncio.run(ingest({"invoices": INVOICES}))
+
+    # the endpoint is not completed, but the changes on the pages before the failed one are loaded
+    assert result == {'completed': [], 'failed': ['invoices']}
+    assert bigquery.loads[-1] == ["invoices"]
+    assert [record["InvoiceID"] for record in read_records("invoices.json")] == ["1", "2", "3", "4"]
+    index = read_index()
+    assert index["5"] == first_index["5"] and index["6"] == first_index["6"]
+    assert index["1"] != first_index["1"]
+
+    # the next complete run still sees the records past the failed page as changed, and deletes nothing
+    xero.failing_pages = set()
+    asyncio.run(ingest({"invoices": INVOICES}))
+    records = read_records("invoices.json")
+    assert [(record["InvoiceID"], record["cdc_operation"]) for record in records] == [("5", "update"), ("6", "update")]
+
+def test_salvaged_unit_of_sharded_run_leaves_index_for_its_retry(xero, bigquery, cdc):
+    xero.records["Invoices"] = invoices(6)
+    asyncio.run(ingest({"invoices": INVOICES}))
+    first_index = read_index()
+
+    xero.records["Invoices"] = invoices(6, version=1)
+    xero.failing_pages = {3}
+    unit = WorkUnit("invoices", INVOICES)
+    results = asyncio.run(run_work_units([unit], save_salvaged_index=False))
+    assert results[0]['failed_at'] == 3
+    assert read_index() == first_index
+
+    # the retry refetches the unit whole, so its output holds every change
+    xero.failing_pages = set()
+    asyncio.run(run_work_units([unit], save_salvaged_index=False))
+    assert [record["cdc_operation"] for record in read_records("invoices.json")] == ["update"] * 6
+
+def test_failure_on_first_page_fails_the_endpoint(xero, cdc):
+    xero.records["Invoices"] = invoices(6)
+    xero.failing_pages = {1}
+    assert asyncio.run(run_work_units([WorkUnit("invoices", INVOICES)])) == [None]
+
+def test_transform_pool_is_started_once_and_reused(xero, monkeypatch):
+    monkeypatch.setitem(CONFIG, "TRANSFORM_WORKERS", 2)
+    xero.records["Invoices"] = invoices(6)
+    pool = data_pipeline.start_transform_pool()
+    try:
+        # every worker is forked up front, none by the runs
+        workers = set(pool._processes)
+        assert len(workers) == 2
+        for _ in range(2):
+            results = asyncio.run(run_pipeline({"invoices": INVOICES}))
+            assert results["invoices"]["records"] == 6
+        assert data_pipeline.start_transform_pool() is pool
+        assert set(pool._processes) == workers
+    finally:
+        data_pipeline.stop_transform_pool()
+    assert data_pipeline._transform_pool is None
+
+def test_child_rows_carry_their_parents_changes(xero, bigquery, cdc, monkeypatch):
+    monkeypatch.setitem(CONFIG, "NORMALIZE_NESTED_ARRAYS", True)
+    xero.records["Invoices"] = [
+        {"InvoiceID": "1", "LineItems": [{"Description": "a"}, {"Description": "b"}]},
+        {"InvoiceID": "2", "LineItems": [{"Description": "c"}]},
+    ]
+    asyncio.run(ingest({"invoices": INVOICES}))
+    assert [(row["InvoiceID"], row["cdc_operation"]) for row in read_records("invoices__line_items.json")] == [
+        ("1", "insert"), ("1", "insert"), ("2", "insert"),
+    ]
+
+    # a changed line updates its parent, whose lines are all emitted again; a
+    # deleted parent gets one child tombstone standing for all of its lines
+    xero.records["Invoices"] = [{"InvoiceID": "1", "LineItems": [{"Description": "a"}, {"Description": "changed"}]}]
+    asyncio.run(ingest({"invoices": INVOICES}))
+    assert [(row["InvoiceID"], row["cdc_operation"]) for row in read_records("invoices.json")] == [
+        ("1", "update"), ("2", "delete"),
+    ]
+    child_rows = read_records("invoices__line_items.json")
+    assert [(row["InvoiceID"], row.get("line_index"), row["cdc_operation"]) for row in child_rows] == [
+        ("1", 0, "update"), ("1", 1, "update"), ("2", None, "delete"),
+    ]
+    payments = read_records("invoices__payments.json")
+    assert [(row["InvoiceID"], row["cdc_operation"]) for row in payments] == [("2", "delete")]
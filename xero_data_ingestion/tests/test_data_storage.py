@@ -0,0 +1,56 @@
+import io
+import os
+
+import pytest
+
+import data_storage
+from config import CONFIG
+from data_storage import composite_upload, read_json_from_gcs, upload_file
+from local_storage import LocalBucket
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    monkeypatch.setitem(CONFIG, "COMPOSITE_UPLOAD_THRESHOLD", 1024)
+    monkeypatch.setitem(CONFIG, "COMPOSITE_UPLOAD_PART_SIZE", 10)
+    monkeypatch.setitem(CONFIG, "COMPOSITE_UPLOAD_CONCURRENCY", 4)
+
+def content_of(size):
+    return bytes(index % 251 for index in range(size))
+
+def bucket_files(bucket):
+    return sorted(blob.name for blob in bucket.list_blobs())
+
+def test_composite_upload_composes_parts_in_order(small_parts, local_storage):
+    bucket = LocalBucket(str(local_storage / "bucket"))
+    content = content_of(10 * 1000 + 7)
+
+    # more parts than one compose request takes, so they are composed in rounds
+    assert composite_upload(bucket, "out.json", io.BytesIO(content), len(content)) == 1001
+    with open(os.path.join(bucket.root, "out.json"), "rb") as composed:
+        assert composed.read() == content
+    assert bucket_files(bucket) == ["out.json"]
+
+def test_composite_upload_deletes_parts_when_it_fails(small_parts, local_storage, monkeypatch):
+    bucket = LocalBucket(str(local_storage / "bucket"))
+    content = content_of(10 * 100)
+    compose_blobs = data_storage.compose_blobs
+
+    def failing_compose(bucket, file_name, sources):
+        if file_name == "out.json":
+            raise RuntimeError("compose failed")
+        return compose_blobs(bucket, file_name, sources)
+
+    monkeypatch.setattr(data_storage, "compose_blobs", failing_compose)
+    with pytest.raises(RuntimeError):
+        composite_upload(bucket, "out.json", io.BytesIO(content), len(content))
+    assert bucket_files(bucket) == []
+
+def test_upload_file_picks_single_or_composite_upload(small_parts):
+    bucket_name = CONFIG['BUCKET_NAME']
+    upload_file(bucket_name, "small.json", io.BytesIO(b'{"a": 1}\n'))
+    large = b'{"a": 1}\n' * 200
+    upload_file(bucket_name, "large.json", io.BytesIO(large))
+
+    assert read_json_from_gcs(bucket_name, "small.json") == '{"a": 1}\n'
+    assert read_json_from_gcs(bucket_name, "large.json") == large.decode()
+    assert read_json_from_gcs(bucket_name, "missing.json") is None
@@ -0,0 +1,54 @@
+from datetime import date
+
+from date_windows import build_windows, estimate_pages, split_window, where_clause
+
+FIRST_DAY = date(2010, 1, 1)
+TODAY = date(2026, 10, 19)
+
+def assert_covers_all_dates(windows):
+    assert windows[0][0] is None and windows[-1][1] is None
+    for (_, end), (start, _) in zip(windows, windows[1:]):
+        assert end == start
+
+def test_windows_without_history_are_coarse():
+    windows = build_windows(FIRST_DAY, TODAY, 12, 20)
+    assert_covers_all_dates(windows)
+    # 2010 through 2025, the months of 2026 so far, and the two open-ended windows
+    assert len(windows) == 19
+    assert windows[1] == (date(2010, 1, 1), date(2011, 1, 1))
+    assert windows[-2] == (date(2026, 1, 1), date(2026, 10, 1))
+
+def test_dense_windows_are_split_and_sparse_ones_merged():
+    history = [
+        [None, "2010-01-01", 0],
+        *[[f"{year}-01-01", f"{year + 1}-01-01", 0] for year in range(2010, 2024)],
+        ["2024-01-01", "2025-01-01", 100],
+        ["2025-01-01", "2026-01-01", 10],
+        ["2026-01-01", "2026-10-01", 10],
+        ["2026-10-01", None, 1],
+    ]
+    windows = build_windows(FIRST_DAY, TODAY, 12, 20, history)
+    assert_covers_all_dates(windows)
+    # 2024 is split in five; the empty years merge into its first part, 2025 and 2026 into one
+    assert windows[1] == (date(2010, 1, 1), date(2024, 3, 14))
+    assert len([window for window in windows if window[0] and window[0].year == 2024]) == 4
+    assert windows[-2] == (date(2025, 1, 1), date(2026, 10, 1))
+    assert len(windows) == 8
+    # windows are split on whole days, so a part may hold a fraction of a page more
+    assert all(round(estimate_pages(window, history)) <= 20 for window in windows[1:-1])
+
+def test_estimate_pages_spreads_history_over_days():
+    history = [["2024-01-01", "2024-01-11", 10]]
+    assert estimate_pages((date(2024, 1, 1), date(2024, 1, 6)), history) == 5
+    assert estimate_pages((date(2025, 1, 1), date(2025, 2, 1)), history) is None
+    assert estimate_pages((None, date(2024, 1, 6)), history) is None
+
+def test_split_window_into_equal_parts():
+    parts = split_window((date(2024, 1, 1), date(2024, 1, 11)), 2)
+    assert parts == [(date(2024, 1, 1), date(2024, 1, 6)), (date(2024, 1, 6), date(2024, 1, 11))]
+
+def test_where_clause():
+    assert where_clause("Date", (date(2024, 1, 1), None)) == "Date >= DateTime(2024, 01, 01)"
+    assert where_clause("Date", (date(2024, 1, 1), date(2024, 2, 1))) == (
+        "Date >= DateTime(2024, 01, 01) && Date < DateTime(2024, 02, 01)"
+    )
@@ -0,0 +1,58 @@
+import asyncio
+
+from flow_control import BudgetLease, ByteBudget
+
+async def is_blocked(awaitable) -> bool:
+    task = asyncio.ensure_future(awaitable)
+    await asyncio.sleep(0.01)
+    blocked = not task.done()
+    task.cancel()
+    return blocked
+
+def test_acquire_waits_for_room():
+    async def scenario():
+        budget = ByteBudget(100)
+        await budget.acquire(60)
+        assert await is_blocked(budget.acquire(60))
+        await budget.release(60)
+        await budget.acquire(60)
+        assert budget.held == 60
+
+    asyncio.run(scenario())
+
+def test_oversized_request_is_granted_when_nothing_is_held():
+    async def scenario():
+        budget = ByteBudget(100)
+        await budget.acquire(500)
+        assert budget.held == 500
+
+    asyncio.run(scenario())
+
+def test_resize_never_waits_and_holds_back_acquire():
+    async def scenario():
+        budget = ByteBudget(100)
+        await budget.acquire(80)
+        # growing past the budget is granted at once
+        await asyncio.wait_for(budget.resize(80, 150), 1)
+        assert budget.held == 150
+        assert await is_blocked(budget.acquire(10))
+        # shrinking wakes waiting acquires
+        waiting = asyncio.ensure_future(budget.acquire(10))
+        await budget.resize(150, 50)
+        await asyncio.wait_for(waiting, 1)
+        assert budget.held == 60
+
+    asyncio.run(scenario())
+
+def test_lease_returns_what_it_holds_on_close():
+    async def scenario():
+        budget = ByteBudget(100)
+        lease = BudgetLease(budget)
+        await lease.acquire(30)
+        await lease.resize(30, 45)
+        await lease.acquire(20)
+        assert (lease.held, budget.held) == (65, 65)
+        await lease.close()
+        assert (lease.held, budget.held) == (0, 0)
+
+    asyncio.run(scenario())
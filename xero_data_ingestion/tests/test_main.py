@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+import pytest
+
+from change_capture import pending_index_file_name
+from config import CONFIG
+from data_storage import read_json_from_gcs
+from main import ingest
+
+INVOICES = "https://api.xero.com/api.xro/2.0/Invoices"
+ACCOUNTS = "https://api.xero.com/api.xro/2.0/Accounts"
+
+def invoices(count, version=0):
+    return [{"InvoiceID": str(index), "Total": index + version} for index in range(1, count + 1)]
+
+def read_changes(name="invoices"):
+    content = read_json_from_gcs(CONFIG['BUCKET_NAME'], f"{name}.json") or ""
+    return [(record["InvoiceID"], record["cdc_operation"]) for record in map(json.loads, content.splitlines())]
+
+@pytest.fixture
+def cdc(monkeypatch):
+    monkeypatch.setitem(CONFIG, "CDC_ENABLED", True)
+
+def test_changes_of_a_failed_load_are_emitted_again(xero, bigquery, cdc):
+    xero.records["Invoices"] = invoices(3)
+    asyncio.run(ingest({"invoices": INVOICES}))
+
+    xero.records["Invoices"] = invoices(2, version=1)
+    bigquery.failing_tables = {"invoices"}
+    assert asyncio.run(ingest({"invoices": INVOICES})) == {'completed': [], 'failed': ['invoices']}
+    assert read_json_from_gcs(CONFIG['BUCKET_NAME'], pending_index_file_name("invoices")) is not None
+
+    # the index stays that of the last loaded run, so the next delta repeats the lost one
+    bigquery.failing_tables = set()
+    assert asyncio.run(ingest({"invoices": INVOICES})) == {'completed': ['invoices'], 'failed': []}
+    assert read_changes() == [("1", "update"), ("2", "update"), ("3", "delete")]
+    assert read_json_from_gcs(CONFIG['BUCKET_NAME'], pending_index_file_name("invoices")) is None
+
+    assert asyncio.run(ingest({"invoices": INVOICES})) == {'completed': ['invoices'], 'failed': []}
+    assert read_changes() == []
+
+def test_failed_endpoint_is_not_loaded(xero, bigquery, cdc):
+    xero.records["Invoices"] = invoices(3)
+    asyncio.run(ingest({"invoices": INVOICES}))
+
+    # its previous delta is still in the bucket and must not be appended again
+    xero.failing_keys = {"Invoices"}
+    result = asyncio.run(ingest({"accounts": ACCOUNTS, "invoices": INVOICES}))
+    assert result == {'completed': ['accounts'], 'failed': ['invoices']}
+    assert bigquery.loads[-1] == ["accounts"]
+
+def test_failed_date_window_does_not_hold_back_other_endpoints(xero, bigquery, cdc, monkeypatch):
+    monkeypatch.setitem(CONFIG, "DATE_WINDOWS_ENABLED", True)
+    xero.records["Accounts"] = [{"AccountID": "1", "Name": "Sales"}]
+    xero.records["Invoices"] = invoices(3)
+    xero.failing_keys = {"Invoices"}
+    endpoints = {"accounts": ACCOUNTS, "invoices": INVOICES}
+
+    # a lone task outside Cloud Run cannot resume the run of its windows
+    with pytest.raises(RuntimeError):
+        asyncio.run(ingest(endpoints))
+    assert bigquery.loads == [["accounts"]]
+
+    xero.failing_keys = set()
+    assert asyncio.run(ingest(endpoints)) == {'completed': ['accounts', 'invoices'], 'failed': []}
+    assert bigquery.loads[1:] == [["accounts"], ["invoices"]]
+    # the account was loaded by the failed run, so it is unchanged now
+    assert read_json_from_gcs(CONFIG['BUCKET_NAME'], "accounts.json") == ""
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from profiling import Profile, endpoint_scope, start_profile, stop_profile, timed
+
+@pytest.fixture
+def profile():
+    profile = start_profile("none", memory=False)
+    yield profile
+    stop_profile()
+
+def calls(profile):
+    return {endpoint: {stage: entry['calls'] for stage, entry in stages.items()} for endpoint, stages in profile.stages.items()}
+
+def run_timed(stage, endpoint=None):
+    with timed(stage, endpoint):
+        pass
+
+def test_timed_attributes_to_the_scoped_endpoint(profile):
+    async def work():
+        with endpoint_scope("invoices"):
+            with timed('fetch'):
+                pass
+            # threads started from the scope inherit its endpoint
+            await asyncio.to_thread(run_timed, 'upload')
+        with timed('auth'):
+            pass
+
+    asyncio.run(work())
+    assert calls(profile) == {"invoices": {"fetch": 1, "upload": 1}, "_run": {"auth": 1}}
+
+def test_explicit_endpoint_overrides_the_scope(profile):
+    with endpoint_scope("invoices"):
+        run_timed('load', "invoices__line_items")
+        run_timed('load')
+    assert calls(profile) == {"invoices__line_items": {"load": 1}, "invoices": {"load": 1}}
+
+def test_timed_is_a_no_op_without_a_profile():
+    assert stop_profile() is None
+    run_timed('fetch', "invoices")
+    with endpoint_scope("invoices"):
+        run_timed('fetch')
+
+def test_report_totals_stages_in_pipeline_order():
+    profile = Profile("none", memory=False)
+    profile.record('upload', "invoices", 0.5)
+    profile.record('fetch', "invoices", 1.0)
+    profile.record('fetch', "accounts", 0.25)
+    profile.record('fetch', "accounts", 0.25)
+    profile.record('auth', None, 0.1)
+    profile.phases['pipeline'] = 2.0
+
+    report = profile.report()
+    assert report['mode'] == "none"
+    assert report['phases'] == {'pipeline': 2.0}
+    assert list(report['stages']) == ["auth", "fetch", "upload"]
+    assert report['stages']['fetch'] == {'seconds': 1.5, 'calls': 3}
+    assert list(report['endpoints']) == ["_run", "accounts", "invoices"]
+    assert report['endpoints']['invoices'] == {
+        'fetch': {'seconds': 1.0, 'calls': 1}, 'upload': {'seconds': 0.5, 'calls': 1},
+    }
+    assert 'memory' not in report
@@ -0,0 +1,50 @@
+import pytest
+
+from api_client import RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD
+from config import CONFIG
+from quota_planner import DEFAULT_PAGES, estimate_endpoint, plan_run
+
+ENDPOINTS = {name: f"https://api.xero.com/api.xro/2.0/{name}" for name in ("accounts", "contacts", "invoices", "items")}
+
+@pytest.fixture
+def budget(monkeypatch):
+    # a run may spend 100 calls
+    monkeypatch.setitem(CONFIG, "DAILY_CALL_LIMIT", 200)
+    monkeypatch.setitem(CONFIG, "QUOTA_SHARE", 0.5)
+
+def test_estimate_from_the_last_completed_run():
+    history = {"invoices": {"pages": 30, "seconds": 42.0, "completed_at": "2026-10-18T00:00:00"}}
+    assert estimate_endpoint("invoices", history) == {
+        "calls": 30, "seconds": 42.0, "last_completed_at": "2026-10-18T00:00:00",
+    }
+
+def test_estimate_without_history():
+    assert estimate_endpoint("invoices", {}) == {
+        "calls": DEFAULT_PAGES,
+        "seconds": round(DEFAULT_PAGES * RATE_LIMIT_PERIOD / RATE_LIMIT_CALLS, 1),
+        "last_completed_at": None,
+    }
+
+def test_plan_runs_the_longest_waiting_endpoints_first(budget):
+    history = {
+        "accounts": {"pages": 40, "seconds": 10, "completed_at": "2026-10-18T00:00:00"},
+        "contacts": {"pages": 50, "seconds": 20, "completed_at": "2026-10-17T00:00:00"},
+        "invoices": {"pages": 150, "seconds": 90, "completed_at": "2026-10-10T00:00:00"},
+    }
+    plan = plan_run(ENDPOINTS, history, None)
+    assert plan["budget_calls"] == 100
+    # never completed first, then the least recently completed
+    assert list(plan["run"]) == ["items", "contacts", "accounts"]
+    assert plan["planned_calls"] == 91
+    assert plan["deferred"]["invoices"]["reason"] == "exceeds the whole run budget"
+    assert plan["estimated_seconds"] == round(91 * RATE_LIMIT_PERIOD / RATE_LIMIT_CALLS, 1)
+
+def test_plan_defers_what_the_remaining_quota_does_not_cover(budget):
+    history = {
+        "accounts": {"pages": 40, "seconds": 10, "completed_at": "2026-10-18T00:00:00"},
+        "contacts": {"pages": 50, "seconds": 20, "completed_at": "2026-10-17T00:00:00"},
+    }
+    plan = plan_run({name: ENDPOINTS[name] for name in history}, history, 60)
+    assert plan["budget_calls"] == 60
+    assert list(plan["run"]) == ["contacts"]
+    assert plan["deferred"]["accounts"]["reason"] == "quota share exhausted"
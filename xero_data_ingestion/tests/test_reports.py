@@ -0,0 +1,114 @@
+import asyncio
+import json
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import reports
+from config import CONFIG
+from data_storage import read_json_from_gcs
+from main import ingest
+from quota_planner import estimate_endpoint
+from reports import flatten_report, report_dates
+
+BALANCE_SHEET = "https://api.xero.com/api.xro/2.0/Reports/BalanceSheet"
+
+REPORT = {
+    "ReportID": "BalanceSheet",
+    "ReportName": "Balance Sheet",
+    "Rows": [
+        {"RowType": "Header", "Cells": [{"Value": ""}, {"Value": "30 Sep 2026"}, {"Value": "30 Sep 2025"}]},
+        {
+            "RowType": "Section",
+            "Title": "Bank",
+            "Rows": [
+                {
+                    "RowType": "Row",
+                    "Cells": [
+                        {"Value": "Business Account", "Attributes": [{"Id": "account", "Value": "acc-1"}]},
+                        {"Value": "100.00"},
+                        {"Value": "80.00"},
+                    ],
+                },
+                {"RowType": "SummaryRow", "Cells": [{"Value": "Total Bank"}, {"Value": "100.00"}, {"Value": "80.00"}]},
+            ],
+        },
+        {"RowType": "Section", "Title": "", "Rows": []},
+    ],
+}
+
+def test_flatten_report_emits_one_record_per_row_and_column():
+    records = flatten_report(REPORT, date(2026, 9, 30))
+    assert len(records) == 4
+    assert records[0] == {
+        "report_id": "BalanceSheet",
+        "report_name": "Balance Sheet",
+        "report_date": "2026-09-30",
+        "section": "Bank",
+        "row_type": "Row",
+        "row_index": 0,
+        "label": "Business Account",
+        "account_id": "acc-1",
+        "column": "30 Sep 2026",
+        "value": "100.00",
+    }
+    summary = records[3]
+    assert (summary["row_type"], summary["row_index"], summary["label"], summary["account_id"]) == (
+        "SummaryRow", 1, "Total Bank", None,
+    )
+    assert summary["column"] == "30 Sep 2025"
+
+def test_flatten_report_names_columns_without_header_by_index():
+    report = {"Rows": [{"RowType": "Row", "Cells": [{"Value": "Sales"}, {"Value": "5"}]}]}
+    assert flatten_report(report, date(2026, 9, 30))[0]["column"] == "1"
+
+def test_report_dates_are_today_and_previous_month_ends():
+    assert report_dates(date(2026, 3, 10), 4) == [
+        date(2025, 12, 31), date(2026, 1, 31), date(2026, 2, 28), date(2026, 3, 10),
+    ]
+
+@pytest.fixture
+def fetched_dates(monkeypatch):
+    """
+    serves REPORT for any date in place of the Xero API, recording the dates requested
+    """
+    requested = []
+
+    def fetch_report(endpoint, client_id, params):
+        requested.append(params['date'])
+        return json.dumps({"Reports": [REPORT]}).encode("UTF-8")
+
+    monkeypatch.setattr(reports, "fetch_report", fetch_report)
+    # today is open, the three month-ends before it are closed
+    monkeypatch.setitem(CONFIG, "REPORT_PERIODS", 4)
+    monkeypatch.setitem(CONFIG, "REPORT_LOCK_DATE", (datetime.utcnow().date() - timedelta(days=1)).isoformat())
+    return requested
+
+def stored_dates():
+    content = read_json_from_gcs(CONFIG['BUCKET_NAME'], "reports__balance_sheet.json")
+    return sorted({json.loads(line)["report_date"] for line in content.splitlines()})
+
+def test_closed_periods_are_fetched_and_loaded_once(fetched_dates, bigquery):
+    endpoints = {"reports__balance_sheet": BALANCE_SHEET}
+    today = datetime.utcnow().date().isoformat()
+    assert estimate_endpoint("reports__balance_sheet", {})['calls'] == 4
+
+    asyncio.run(ingest(endpoints))
+    assert len(fetched_dates) == 4 and len(stored_dates()) == 4
+
+    # the cached periods cost no calls and are not loaded again
+    fetched_dates.clear()
+    asyncio.run(ingest(endpoints))
+    assert fetched_dates == [today]
+    assert stored_dates() == [today]
+    assert estimate_endpoint("reports__balance_sheet", {})['calls'] == 1
+
+def test_closed_periods_of_a_failed_load_are_fetched_again(fetched_dates, bigquery):
+    endpoints = {"reports__balance_sheet": BALANCE_SHEET}
+    bigquery.failing_tables = {"reports__balance_sheet"}
+    asyncio.run(ingest(endpoints))
+
+    fetched_dates.clear()
+    bigquery.failing_tables = set()
+    asyncio.run(ingest(endpoints))
+    assert len(fetched_dates) == 4 and len(stored_dates()) == 4
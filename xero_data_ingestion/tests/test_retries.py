@@ -0,0 +1,72 @@
+import pytest
+import requests
+
+import retries
+from config import CONFIG
+from retries import CircuitOpenError, call_with_retries, retry_budget_scope
+
+def http_error(status, retry_after=None):
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return requests.HTTPError(f"{status}", response=response)
+
+class FlakyRequest:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return b"{}"
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(retries.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(retries, "_breakers", {})
+    monkeypatch.setitem(CONFIG, "RETRY_MAX_ATTEMPTS", 5)
+    monkeypatch.setitem(CONFIG, "RETRY_MAX_SECONDS", 60)
+    monkeypatch.setitem(CONFIG, "CIRCUIT_FAILURE_THRESHOLD", 3)
+    monkeypatch.setitem(CONFIG, "CIRCUIT_RESET_SECONDS", 60)
+
+def test_transient_failure_costs_one_more_request():
+    request = FlakyRequest(http_error(503))
+    assert call_with_retries("tenant", "page 180", request) == b"{}"
+    assert request.calls == 2
+
+def test_client_errors_are_not_retried():
+    request = FlakyRequest(http_error(404))
+    with pytest.raises(requests.HTTPError):
+        call_with_retries("tenant", "page 1", request)
+    assert request.calls == 1
+
+def test_run_budget_bounds_retries_across_requests():
+    with retry_budget_scope(2):
+        assert call_with_retries("tenant", "page 1", FlakyRequest(http_error(500))) == b"{}"
+        request = FlakyRequest(http_error(500), http_error(500))
+        with pytest.raises(requests.HTTPError):
+            call_with_retries("tenant", "page 2", request)
+    assert request.calls == 2
+
+def test_breaker_opens_per_tenant_after_consecutive_failures():
+    failing = FlakyRequest(*[requests.ConnectionError()] * 5)
+    # the attempt after the third failure is refused by the now open breaker
+    with pytest.raises(CircuitOpenError):
+        call_with_retries("tenant", "page 1", failing)
+    assert failing.calls == 3
+    request = FlakyRequest()
+    with pytest.raises(CircuitOpenError):
+        call_with_retries("tenant", "page 2", request)
+    assert request.calls == 0
+    assert call_with_retries("other-tenant", "page 1", FlakyRequest()) == b"{}"
+
+def test_long_retry_after_trips_the_breaker_instead_of_waiting():
+    request = FlakyRequest(http_error(429, retry_after=3600))
+    with pytest.raises(requests.HTTPError):
+        call_with_retries("tenant", "page 1", request)
+    assert request.calls == 1
+    with pytest.raises(CircuitOpenError):
+        call_with_retries("tenant", "page 2", FlakyRequest())
@@ -0,0 +1,110 @@
+import asyncio
+import importlib
+import sys
+import threading
+import time
+
+import pytest
+
+from config import CONFIG
+
+def test_service_refuses_transform_workers(monkeypatch):
+    monkeypatch.setitem(CONFIG, "TRANSFORM_WORKERS", 2)
+    monkeypatch.delitem(sys.modules, "server", raising=False)
+    with pytest.raises(ValueError):
+        importlib.import_module("server")
+
+class FakeIngest:
+    """
+    stands in for main.ingest: each sync runs until its tenant's gate is opened
+
+    Attributes:
+        gates (Dict[str, threading.Event]): gate per tenant
+        running (List[str]): tenants whose syncs are running
+        started (List[str]): tenants in the order their syncs started
+    """
+
+    def __init__(self):
+        self.gates = {}
+        self.running = []
+        self.started = []
+
+    async def __call__(self, endpoints):
+        client_id = CONFIG['CLIENT_ID']
+        self.running.append(client_id)
+        self.started.append(client_id)
+        try:
+            await asyncio.to_thread(self.gates.setdefault(client_id, threading.Event()).wait, 10)
+        finally:
+            self.running.remove(client_id)
+        return {'completed': list(endpoints), 'failed': []}
+
+@pytest.fixture
+def fake_ingest(monkeypatch):
+    import server
+    fake = FakeIngest()
+    for tenant in ("tenant-a", "tenant-b"):
+        fake.gates[tenant] = threading.Event()
+    monkeypatch.setattr(server, "ingest", fake)
+    monkeypatch.setattr(server, "preload_secrets", lambda client_ids: None)
+    service = server.SyncService(max_concurrent_syncs=4)
+    monkeypatch.setattr(server, "_service", service)
+    yield fake
+    for gate in fake.gates.values():
+        gate.set()
+    wait_for(lambda: all(service.status(sync_id)['status'] not in ('queued', 'running') for sync_id in list(service.syncs)))
+    service.loop.call_soon_threadsafe(service.loop.stop)
+
+@pytest.fixture
+def client(monkeypatch):
+    import server
+    monkeypatch.setitem(CONFIG, "SERVICE_API_KEY", "secret")
+    monkeypatch.setitem(CONFIG, "ENDPOINTS", {
+        "accounts": "https://api.xero.com/api.xro/2.0/Accounts",
+        "invoices": "https://api.xero.com/api.xro/2.0/Invoices",
+    })
+    return server.app.test_client()
+
+def post_sync(client, body, api_key="secret"):
+    return client.post("/sync", json=body, headers={"X-API-KEY": api_key})
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+@pytest.mark.parametrize("body", [
+    {"tenant": 123},
+    {"tenant": ["tenant-a"]},
+    {"tenant": "../tenant"},
+    {"endpoints": "invoices"},
+    {"endpoints": [["invoices"]]},
+    {"endpoints": ["no-such-endpoint"]},
+    ["invoices"],
+])
+def test_invalid_sync_requests_are_rejected(client, fake_ingest, body):
+    assert post_sync(client, body).status_code == 400
+    assert fake_ingest.started == []
+
+def test_wrong_or_missing_api_key_is_rejected(client, fake_ingest):
+    assert post_sync(client, {}, api_key="wrong").status_code == 401
+    assert client.post("/sync", json={}).status_code == 401
+    assert client.get("/").status_code == 200
+
+def test_syncs_of_a_tenant_queue_while_other_tenants_run(client, fake_ingest):
+    first = post_sync(client, {"tenant": "tenant-a", "endpoints": ["invoices"]}).get_json()['sync_id']
+    second = post_sync(client, {"tenant": "tenant-a", "endpoints": ["accounts"]}).get_json()['sync_id']
+    other = post_sync(client, {"tenant": "tenant-b", "endpoints": ["invoices"]}).get_json()['sync_id']
+
+    def status(sync_id):
+        return client.get(f"/syncs/{sync_id}", headers={"X-API-KEY": "secret"}).get_json()['status']
+
+    wait_for(lambda: sorted(fake_ingest.running) == ["tenant-a", "tenant-b"])
+    assert (status(first), status(second), status(other)) == ("running", "queued", "running")
+
+    fake_ingest.gates["tenant-a"].set()
+    wait_for(lambda: status(second) == "succeeded")
+    assert status(first) == "succeeded"
+    assert status(other) == "running"
+    assert fake_ingest.started == ["tenant-a", "tenant-b", "tenant-a"]
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import pytest
+
+import sharding
+from config import CONFIG
+from data_pipeline import WorkUnit
+from manifest import LocalManifestStore, ManifestStore
+from sharding import assign_units, run_sharded, split_endpoint
+
+INVOICES = "https://api.xero.com/api.xro/2.0/Invoices"
+ACCOUNTS = "https://api.xero.com/api.xro/2.0/Accounts"
+
+def test_assign_units_balances_heaviest_first():
+    units = [WorkUnit(f"endpoint_{index}", INVOICES) for index in range(6)]
+    weights = {unit.key: pages for unit, pages in zip(units, [50, 40, 30, 20, 10, 10])}
+    assignments = assign_units(units, weights, 2)
+
+    loads = [0, 0]
+    for unit in units:
+        loads[assignments[unit.key]] += weights[unit.key]
+    assert sorted(loads) == [80, 80]
+    # the assignment only depends on the units and weights, not on their order
+    assert assign_units(list(reversed(units)), weights, 2) == assignments
+
+def test_split_endpoint_into_page_ranges(monkeypatch):
+    monkeypatch.setitem(CONFIG, "SHARD_PAGES_PER_UNIT", 50)
+    units = split_endpoint("invoices", INVOICES, {'pages': 120}, "run-1")
+    assert [(unit.start_page, unit.end_page) for unit in units] == [(1, 50), (51, 100), (101, None)]
+    assert [unit.key for unit in units] == ["invoices.pages-00001", "invoices.pages-00051", "invoices.pages-00101"]
+    assert split_endpoint("invoices", INVOICES, {'pages': 20}, "run-1") == [WorkUnit("invoices", INVOICES)]
+
+def test_reports_are_never_split(monkeypatch):
+    monkeypatch.setitem(CONFIG, "SHARD_PAGES_PER_UNIT", 1)
+    assert len(split_endpoint("reports__balance_sheet", INVOICES, {'pages': 36}, "run-1")) == 1
+
+def test_manifest_store_backends_must_be_complete():
+    class PartialStore(ManifestStore):
+        def create(self, name, content):
+            return True
+
+    with pytest.raises(TypeError):
+        PartialStore()
+
+def test_failed_finalization_is_retried(xero, bigquery, monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG, "SHARD_RUN_ID", "run-1")
+    monkeypatch.setitem(CONFIG, "SHARD_MANIFEST_DIR", str(tmp_path / "manifests"))
+    xero.records["Invoices"] = [{"InvoiceID": "1"}]
+    xero.records["Accounts"] = [{"AccountID": "1"}]
+    bigquery.failing_tables = {"invoices"}
+    endpoints = {"accounts": ACCOUNTS, "invoices": INVOICES}
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_sharded(endpoints))
+
+    # the retry of the task finds its claim without the finalized marker and
+    # finalizes again, only loading what did not load before
+    bigquery.failing_tables = set()
+    assert asyncio.run(run_sharded(endpoints)) is True
+    assert bigquery.loads == [["accounts", "invoices"], ["invoices"]]
+    store = LocalManifestStore(str(tmp_path / "manifests"), "run-1")
+    assert json.loads(store.read(sharding.FINALIZED)) == {'task_index': 0}
+
+    # once finalized, the run is never loaded again
+    assert asyncio.run(run_sharded(endpoints)) is False
+    assert len(bigquery.loads) == 2
@@ -0,0 +1,83 @@
+import json
+
+from change_capture import record_hash
+from transforms import encode_page, hash_and_encode_page, split_record, tag_line
+
+PAGE = json.dumps({
+    "pagination": {"page": 1, "pageCount": 1},
+    "Invoices": [
+        {"InvoiceID": "1", "Total": 10, "UpdatedDateUTC": "a"},
+        {"InvoiceID": "2", "Total": 20, "UpdatedDateUTC": "b"},
+    ],
+}).encode("UTF-8")
+
+CHILDREN = {"invoices__line_items": "LineItems", "invoices__payments": "Payments"}
+
+def decode(content):
+    return [json.loads(line) for line in content.splitlines()]
+
+def test_encode_page_stamps_records_as_ndjson():
+    outputs, record_count = encode_page(PAGE, "Invoices", "2026-10-19T00:00:00", "invoices")
+    assert record_count == 2
+    assert list(outputs) == ["invoices"]
+    assert outputs["invoices"].endswith(b"\n")
+    assert decode(outputs["invoices"]) == [
+        {"InvoiceID": "1", "Total": 10, "UpdatedDateUTC": "a", "ingestion_time": "2026-10-19T00:00:00"},
+        {"InvoiceID": "2", "Total": 20, "UpdatedDateUTC": "b", "ingestion_time": "2026-10-19T00:00:00"},
+    ]
+
+def test_encode_page_without_records():
+    content = json.dumps({"Invoices": []}).encode("UTF-8")
+    assert encode_page(content, "Invoices", "2026-10-19T00:00:00", "invoices") == ({"invoices": b""}, 0)
+
+def test_hash_and_encode_page_returns_id_digest_and_line_per_record():
+    volatile = frozenset({"UpdatedDateUTC"})
+    hashed = hash_and_encode_page(PAGE, "Invoices", "2026-10-19T00:00:00", "InvoiceID", volatile)
+    assert [(record_id, digest) for record_id, digest, _, _ in hashed] == [
+        ("1", record_hash({"InvoiceID": "1", "Total": 10}, volatile)),
+        ("2", record_hash({"InvoiceID": "2", "Total": 20}, volatile)),
+    ]
+    _, _, line, child_lines = hashed[0]
+    # lines come without a trailing newline, ready to be tagged
+    assert json.loads(line) == {"InvoiceID": "1", "Total": 10, "UpdatedDateUTC": "a", "ingestion_time": "2026-10-19T00:00:00"}
+    assert child_lines == {}
+
+def test_split_record_explodes_nested_arrays_into_child_rows():
+    item = {"InvoiceID": "1", "LineItems": [{"Description": "a"}, "b"], "Payments": None}
+    parent, child_rows = split_record(item, "2026-10-19T00:00:00", "InvoiceID", CHILDREN)
+    assert parent == {"InvoiceID": "1", "ingestion_time": "2026-10-19T00:00:00"}
+    assert child_rows == {
+        "invoices__line_items": [
+            {"InvoiceID": "1", "line_index": 0, "Description": "a", "ingestion_time": "2026-10-19T00:00:00"},
+            {"InvoiceID": "1", "line_index": 1, "value": "b", "ingestion_time": "2026-10-19T00:00:00"},
+        ],
+        "invoices__payments": [],
+    }
+
+def test_split_record_without_children_only_stamps():
+    item = {"InvoiceID": "1", "LineItems": [{"Description": "a"}]}
+    assert split_record(item, "t", "InvoiceID", {}) == ({**item, "ingestion_time": "t"}, {})
+
+def test_encode_page_writes_one_output_per_child_table():
+    content = json.dumps({"Invoices": [{"InvoiceID": "1", "LineItems": [{"Description": "a"}]}]}).encode("UTF-8")
+    outputs, record_count = encode_page(content, "Invoices", "t", "invoices", "InvoiceID", CHILDREN)
+    assert record_count == 1
+    assert decode(outputs["invoices"]) == [{"InvoiceID": "1", "ingestion_time": "t"}]
+    assert decode(outputs["invoices__line_items"]) == [
+        {"InvoiceID": "1", "line_index": 0, "Description": "a", "ingestion_time": "t"},
+    ]
+    assert outputs["invoices__payments"] == b""
+
+def test_digest_covers_nested_arrays():
+    def digest(description):
+        item = {"InvoiceID": "1", "LineItems": [{"Description": description}]}
+        content = json.dumps({"Invoices": [item]}).encode("UTF-8")
+        return hash_and_encode_page(content, "Invoices", "t", "InvoiceID", frozenset(), CHILDREN)[0][1]
+
+    assert digest("a") != digest("b")
+
+def test_tag_line_appends_the_operation():
+    line = json.dumps({"InvoiceID": "1", "line_index": 0, "ingestion_time": "t"}).encode("UTF-8")
+    assert json.loads(tag_line(line, "update")) == {
+        "InvoiceID": "1", "line_index": 0, "ingestion_time": "t", "cdc_operation": "update",
+    }